@@ -1,37 +1,70 @@
+import asyncio
+import logging
 import os
 import json
-import requests
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 from temporalio import activity
-from openai import AsyncAssistantEventHandler, AsyncOpenAI, OpenAI
+from openai import AsyncAssistantEventHandler, AsyncOpenAI, NotFoundError, OpenAI, OpenAIError
 from functions.common import process_function_calls
 from typing import Deque, List, Optional, Tuple
 from dotenv import load_dotenv
-import redis
+from assistants.assistant_cache import AssistantCache
+from assistants.response_cache import response_cache
+from clients.http_client import http_executor
+from clients.rate_limiter import OPENAI_ESTIMATED_TOKENS_PER_RUN, openai_rate_limiter
+from clients.redis_client import get_redis_client
+from functions.tool_cache import tool_result_cache
+from streaming.publisher import token_publisher
+from streaming.transport import stream_key
+from telemetry.metrics import INTER_TOKEN_GAP, RESPONSE_CACHE_LOOKUPS, SESSIONS_CLOSED, TIME_TO_FIRST_TOKEN
 
 load_dotenv()
 
-REDIS_HOST = os.getenv("REDIS_HOST")
-REDIS_PORT = os.getenv("REDIS_PORT")
+CITY_CACHE_TTL_SECONDS = int(os.getenv("CITY_CACHE_TTL_SECONDS", "86400"))
+IP_GEOLOCATION_URL = os.getenv("IP_GEOLOCATION_URL", "http://ip-api.com/json/")
+# Streaming activities heartbeat every this many events and at least this often, cancellation
+# requests only reach an activity with its heartbeats
+STREAM_HEARTBEAT_EVERY_EVENTS = int(os.getenv("STREAM_HEARTBEAT_EVERY_EVENTS", "20"))
+STREAM_HEARTBEAT_INTERVAL_MS = int(os.getenv("STREAM_HEARTBEAT_INTERVAL_MS", "500"))
+# Size of the text deltas a cached reply is replayed in
+RESPONSE_CACHE_REPLAY_CHUNK_SIZE = 64
 
-redis_client = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+logger = logging.getLogger(__name__)
 
 
 """
     Event handler class for handling various events in the assistant.
 """
 class EventHandler(AsyncAssistantEventHandler):
-    def __init__(self, thread_id: str, run_id: str = "") -> None:
+    def __init__(self, thread_id: str, run_id: str = "", stream_run_id: str = "", wire_format: str = "json") -> None:
         super().__init__()
         self.events: list = []
         self.result: ConversationThreadMessageResponse = ConversationThreadMessageResponse(
             thread_id=thread_id, 
             run_id=run_id
         )
+        # Identifies this stream of text events, consumers drop events they have already seen
+        self.stream_run_id: str = stream_run_id
+        self.seq: int = 0
+        self.wire_format: str = wire_format
+        self.started_at: float = time.perf_counter()
+        self.last_token_at: Optional[float] = None
+        self.usage_tokens: int = 0
+
+    def publish(self, event: str, value: str) -> None:
+        self.seq += 1
+        token_publisher.publish(self.result.thread_id, event, value, self.stream_run_id, self.seq, self.wire_format)
 
     async def on_event(self, event) -> None:
         self.events.append(event)
 
+        if len(self.events) % STREAM_HEARTBEAT_EVERY_EVENTS == 0:
+            activity.heartbeat(self.seq)
+
+        if(event.event == "thread.run.completed" and event.data.usage):
+            self.usage_tokens = event.data.usage.total_tokens
+
         if(event.event == "thread.run.failed"):
             self.result.failed = True
             self.result.error_code = event.data.last_error.code
@@ -39,22 +72,28 @@ class EventHandler(AsyncAssistantEventHandler):
 
     async def on_text_created(self, text) -> None:
         print("Received text created event: " + text.value)
-        redis_client.publish(self.result.thread_id, json.dumps({"e": "on_text_created", "v": text.value}))
+        self.publish("on_text_created", text.value)
         self.result.message = text.value
 
     async def on_text_delta(self, delta, snapshot):
-        redis_client.publish(self.result.thread_id, json.dumps({"e": "on_text_delta", "v": delta.value}))
+        now = time.perf_counter()
+        if self.last_token_at is None:
+            TIME_TO_FIRST_TOKEN.labels("worker").observe(now - self.started_at)
+        else:
+            INTER_TOKEN_GAP.observe(now - self.last_token_at)
+        self.last_token_at = now
+
+        self.publish("on_text_delta", delta.value)
         if not delta.annotations:
             self.result.message += delta.value
 
     async def on_text_done(self, text):
-        redis_client.publish(self.result.thread_id, json.dumps({"e": "on_text_done", "v": text.value}))
+        self.publish("on_text_done", text.value)
         print("Received text done event: " + text.value)
         self.result.message = text.value
 
     async def on_tool_call_created(self, tool_call):
         self.result.tool_call_needed = True
-        self.result.tool_call_id = tool_call.id
 
     async def on_tool_call_delta(self, delta, snapshot):
         print("Tool Call Delta, delta", delta)
@@ -82,11 +121,55 @@ class EventHandler(AsyncAssistantEventHandler):
             pass
         elif tool_call.type == "function":
             print("function_call")
-            # Parse the arguments
-            self.result.tool_call_function_name = tool_call.function.name
-            self.result.tool_arguments = json.loads(tool_call.function.arguments)
+            # Parse the arguments, a single step can request several function calls
+            self.result.tool_calls.append(ToolCallRequest(
+                tool_call_id=tool_call.id,
+                tool_function_name=tool_call.function.name,
+                tool_arguments=json.loads(tool_call.function.arguments),
+            ))
+
+
 
 
+async def heartbeat_periodically() -> None:
+    """
+    Keeps heartbeating while a stream is silent, e.g. before the first token.
+    """
+    while True:
+        activity.heartbeat()
+        await asyncio.sleep(STREAM_HEARTBEAT_INTERVAL_MS / 1000)
+
+
+async def acquire_rate_limit(call: str, tokens: int = 0) -> None:
+    """
+    Waits for the rate limiter while heartbeating, the wait can outlast the heartbeat timeout.
+    """
+    heartbeats = asyncio.create_task(heartbeat_periodically())
+    try:
+        await openai_rate_limiter.acquire(call, tokens)
+    finally:
+        heartbeats.cancel()
+
+
+def cancelled_by_workflow() -> bool:
+    """
+    Whether the workflow asked for the cancellation, e.g. the user stopped the reply, rather
+    than the worker shutting down or the activity timing out. The latter are retried.
+    """
+    if activity.is_worker_shutdown():
+        return False
+    # Cancellation details are only reported by newer Temporal SDKs
+    cancellation_details = getattr(activity, "cancellation_details", None)
+    details = cancellation_details() if cancellation_details else None
+    return details.cancel_requested if details is not None else True
+
+
+def get_stream_run_id() -> str:
+    """
+    Stream run id of the current activity attempt, a retried attempt streams under a new id.
+    """
+    info = activity.info()
+    return f"{info.workflow_run_id}:{info.activity_id}:{info.attempt}"
 
 
 @dataclass
@@ -105,6 +188,16 @@ class SubmitToolOutputsRequest:
     thread_id: str
     run_id: str
     tool_outputs: list[ToolCallResult]
+    wire_format: str = "json"
+
+@dataclass
+class ConversationThreadRunRequest:
+    thread_id: str
+    # Encoding of the streamed events, negotiated with the app when the conversation starts
+    wire_format: str = "json"
+    # Set when the reply may come from the response cache, the context is part of the key
+    cache_prompt: str = ""
+    cache_context: str = ""
 
 @dataclass
 class ConversationThreadMessageResponse:
@@ -112,10 +205,8 @@ class ConversationThreadMessageResponse:
     run_id: str = ""
     message: str = ""
     tool_call_needed: bool = False
-    tool_call_id: str = ""
-    tool_call_function_name: str = ""
     tool_type: str = ""
-    tool_arguments: Optional[dict] = None
+    tool_calls: list[ToolCallRequest] = field(default_factory=list)
 
     failed: bool = False
     error_code: Optional[str] = None
@@ -128,13 +219,38 @@ class ConversationThreadMessage:
     message: str
     role: str = "user"
 
+@dataclass
+class CancelRunRequest:
+    thread_id: str
+    run_id: str
+    wire_format: str = "json"
+
+@dataclass
+class EndReplyRequest:
+    thread_id: str
+    # Messages of the burst the reply answered
+    message_ids: List[str] = field(default_factory=list)
+    failed: bool = False
+    # Messages in the conversation after the reply, resumed chats page the history from here
+    history_length: int = 0
+    wire_format: str = "json"
+
+@dataclass
+class CloseThreadRequest:
+    thread_id: str
+    # "ended" by the user or "idle" when the idle timeout reclaimed the session
+    reason: str = "ended"
+    delete_thread: bool = False
+
 class ConversationThreadActivities:
     def __init__(self, openai_api_key: str, openai_gateway_url: str, openai_assistant_id: str) -> None:
         self.openai_assistant_id = openai_assistant_id
         self.openai_client = AsyncOpenAI(api_key=openai_api_key, base_url=openai_gateway_url)
+        self.assistant_cache = AssistantCache(self.openai_client)
 
     @activity.defn
     async def create_thread(self) -> str:
+        await acquire_rate_limit("create_thread")
         thread = await self.openai_client.beta.threads.create()
 
         activity.logger.info("Successfully created a thread: " + thread.id)
@@ -143,43 +259,168 @@ class ConversationThreadActivities:
 
     @activity.defn
     async def add_message_to_thread(self, message: ConversationThreadMessage):
+        await acquire_rate_limit("add_message")
         await self.openai_client.beta.threads.messages.create(
             thread_id=message.thread_id,
             role=message.role,
             content=message.message,
         )
 
+    @activity.defn
+    async def close_thread(self, request: CloseThreadRequest):
+        """
+        Frees what a closed conversation leaves behind, the OpenAI thread only when asked to.
+        """
+        await get_redis_client().delete(stream_key(request.thread_id))
+
+        if request.delete_thread:
+            try:
+                await self.openai_client.beta.threads.delete(request.thread_id)
+            except NotFoundError:
+                # Deleted by an earlier attempt
+                pass
+
+        SESSIONS_CLOSED.labels(request.reason).inc()
+        activity.logger.info(f"Closed thread {request.thread_id} ({request.reason})")
+
     @activity.defn
     async def get_city(self, remote_ip_address: str) -> str:
-        url = f"http://ip-api.com/json/{remote_ip_address}"
-        params = {}
-        headers = {"Content-Type": "application/json"}
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-        return data["city"]
+        async def lookup_city() -> str:
+            data = await http_executor.get_json(IP_GEOLOCATION_URL + remote_ip_address)
+            return data["city"]
+
+        return await tool_result_cache.get_or_call(
+            "get_city",
+            CITY_CACHE_TTL_SECONDS,
+            {"remote_ip_address": remote_ip_address},
+            lookup_city,
+        )
 
     @activity.defn
-    async def get_response(self, thread_id: str) -> ConversationThreadMessageResponse:
-        assistant = await self.openai_client.beta.assistants.retrieve(
-            assistant_id=self.openai_assistant_id
+    async def get_response(self, request: ConversationThreadRunRequest) -> ConversationThreadMessageResponse:
+        thread_id = request.thread_id
+        assistant = await self.assistant_cache.get(self.openai_assistant_id)
+
+        event_handler = EventHandler(
+            thread_id=thread_id,
+            stream_run_id=get_stream_run_id(),
+            wire_format=request.wire_format,
         )
 
-        event_handler = EventHandler(thread_id=thread_id)
+        if request.cache_prompt and response_cache.enabled:
+            cached_reply = await response_cache.get(assistant.id, request.cache_prompt, request.cache_context)
+            RESPONSE_CACHE_LOOKUPS.labels("hit" if cached_reply is not None else "miss").inc()
+            if cached_reply is not None:
+                return await self.replay_cached_reply(event_handler, cached_reply)
 
         # Create and Stream a Run
-        async with self.openai_client.beta.threads.runs.stream(
+        await self.stream_run(
+            self.openai_client.beta.threads.runs.stream(
+                thread_id=thread_id,
+                assistant_id=assistant.id,
+                event_handler=event_handler,
+            ),
+            event_handler,
+            "run",
+            OPENAI_ESTIMATED_TOKENS_PER_RUN,
+        )
+
+        await token_publisher.drain(thread_id)
+
+        result = event_handler.result
+        # Replies that needed tools depend on more than the prompt and context
+        if request.cache_prompt and not result.tool_call_needed and not result.failed:
+            await response_cache.set(assistant.id, request.cache_prompt, request.cache_context, result.message)
+
+        return result
+
+    async def replay_cached_reply(self, event_handler: EventHandler, reply: str) -> ConversationThreadMessageResponse:
+        """
+        Streams a cached reply like a run would and adds it to the thread in place of one.
+        """
+        thread_id = event_handler.result.thread_id
+
+        event_handler.publish("on_text_created", "")
+        for start in range(0, len(reply), RESPONSE_CACHE_REPLAY_CHUNK_SIZE):
+            event_handler.publish("on_text_delta", reply[start:start + RESPONSE_CACHE_REPLAY_CHUNK_SIZE])
+        event_handler.publish("on_text_done", reply)
+
+        await acquire_rate_limit("add_message")
+        await self.openai_client.beta.threads.messages.create(
             thread_id=thread_id,
-            assistant_id=assistant.id,
-            event_handler=event_handler,
-        ) as stream:
-            await stream.until_done()
+            role="assistant",
+            content=reply,
+        )
+
+        await token_publisher.drain(thread_id)
+
+        event_handler.result.message = reply
+        return event_handler.result
+
+    async def stream_run(self, stream_manager, event_handler: EventHandler, call: str, estimated_tokens: int = 0) -> None:
+        """
+        Streams a run while heartbeating, once the rate limiter admits it. When the activity
+        is cancelled the OpenAI run is cancelled too, a thread only takes one active run. If
+        the workflow stopped the reply, consumers get the text streamed so far as the final
+        text. Otherwise the reply is left open for the retried attempt to stream.
+        """
+        heartbeats = asyncio.create_task(heartbeat_periodically())
+        try:
+            await openai_rate_limiter.acquire(call, estimated_tokens)
+
+            async with stream_manager as stream:
+                await stream.until_done()
+
+            # Usage is reported when the whole run completes, tool steps included
+            if event_handler.usage_tokens:
+                await openai_rate_limiter.settle(OPENAI_ESTIMATED_TOKENS_PER_RUN, event_handler.usage_tokens)
+        except asyncio.CancelledError:
+            thread_id = event_handler.result.thread_id
+            run_id = event_handler.current_run.id if event_handler.current_run else event_handler.result.run_id
+            if run_id:
+                await self.cancel_openai_run(thread_id, run_id)
+
+            if cancelled_by_workflow():
+                event_handler.publish("on_text_done", event_handler.result.message)
+                await token_publisher.drain(thread_id)
+            raise
+        finally:
+            heartbeats.cancel()
+
+    async def cancel_openai_run(self, thread_id: str, run_id: str) -> None:
+        try:
+            await self.openai_client.beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id)
+            activity.logger.info(f"Cancelled run {run_id} of thread {thread_id}")
+        except OpenAIError:
+            # The run may have finished in the meantime
+            logger.exception(f"Failed to cancel run {run_id} of thread {thread_id}")
+
+    @activity.defn
+    async def cancel_run(self, request: CancelRunRequest):
+        """
+        Cancels a run that waits for tool outputs and ends the reply for consumers.
+        """
+        await self.cancel_openai_run(request.thread_id, request.run_id)
+
+        token_publisher.publish(request.thread_id, "on_text_done", "", get_stream_run_id(), 1, request.wire_format)
+        await token_publisher.drain(request.thread_id)
 
-            return event_handler.result
+    @activity.defn
+    async def end_reply(self, request: EndReplyRequest):
+        """
+        Ends the reply to a burst for consumers, they stop waiting for the listed messages.
+        """
+        value = json.dumps({
+            "message_ids": request.message_ids,
+            "failed": request.failed,
+            "history_length": request.history_length,
+        })
+        token_publisher.publish(request.thread_id, "on_reply_done", value, get_stream_run_id(), 1, request.wire_format)
+        await token_publisher.drain(request.thread_id)
 
     @activity.defn
     async def function_call(self, request: ToolCallRequest) -> ToolCallResult:
-        result = process_function_calls(
+        result = await process_function_calls(
             request.tool_function_name,
             request.tool_arguments,
         )
@@ -188,16 +429,26 @@ class ConversationThreadActivities:
 
     @activity.defn
     async def submit_tool_call_result(self, request: SubmitToolOutputsRequest) -> ConversationThreadMessageResponse:
-        event_handler = EventHandler(thread_id=request.thread_id, run_id=request.run_id)
-
-        async with self.openai_client.beta.threads.runs.submit_tool_outputs_stream(
+        event_handler = EventHandler(
             thread_id=request.thread_id,
             run_id=request.run_id,
-            tool_outputs=[{"tool_call_id": x.tool_call_id, "output": x.output} for x in request.tool_outputs],
-            event_handler=event_handler,
-        ) as stream:
-            await stream.until_done()
-            print("------------- submit_tool_call_result events: --------------")
-            print(event_handler.events)
-
-            return event_handler.result
\ No newline at end of file
+            stream_run_id=get_stream_run_id(),
+            wire_format=request.wire_format,
+        )
+
+        await self.stream_run(
+            self.openai_client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=request.thread_id,
+                run_id=request.run_id,
+                tool_outputs=[{"tool_call_id": x.tool_call_id, "output": x.output} for x in request.tool_outputs],
+                event_handler=event_handler,
+            ),
+            event_handler,
+            "submit_tool_outputs",
+        )
+        print("------------- submit_tool_call_result events: --------------")
+        print(event_handler.events)
+
+        await token_publisher.drain(request.thread_id)
+
+        return event_handler.result
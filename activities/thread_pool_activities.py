@@ -0,0 +1,80 @@
+import asyncio
+import os
+import time
+from typing import Optional
+from temporalio import activity
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+from clients.rate_limiter import openai_rate_limiter
+from clients.redis_client import get_redis_client
+
+load_dotenv()
+
+THREAD_POOL_KEY = "openai:thread-pool"
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "0"))
+THREAD_POOL_TTL_SECONDS = int(os.getenv("THREAD_POOL_TTL_SECONDS", "3600"))
+THREAD_POOL_REFILL_INTERVAL_SECONDS = int(os.getenv("THREAD_POOL_REFILL_INTERVAL_SECONDS", "10"))
+THREAD_POOL_CREATE_CONCURRENCY = int(os.getenv("THREAD_POOL_CREATE_CONCURRENCY", "10"))
+
+# Pooled threads are kept in a sorted set scored by their expiry time.
+# Expired threads are dropped and the freshest one is popped in a single atomic step.
+CLAIM_THREAD_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local popped = redis.call('ZPOPMAX', KEYS[1])
+if popped[1] then
+    return popped[1]
+end
+return false
+"""
+
+
+class ThreadPoolActivities:
+    def __init__(self, openai_api_key: str, openai_gateway_url: str) -> None:
+        self.openai_client = AsyncOpenAI(api_key=openai_api_key, base_url=openai_gateway_url)
+
+    @activity.defn
+    async def claim_thread(self) -> Optional[str]:
+        thread_id = await get_redis_client().eval(CLAIM_THREAD_SCRIPT, 1, THREAD_POOL_KEY, time.time())
+        if not thread_id:
+            return None
+
+        thread_id = thread_id.decode()
+        activity.logger.info("Claimed pooled thread: " + thread_id)
+
+        return thread_id
+
+    @activity.defn
+    async def refill_thread_pool(self, target_size: int) -> int:
+        redis_client = get_redis_client()
+
+        now = time.time()
+        await redis_client.zremrangebyscore(THREAD_POOL_KEY, "-inf", now)
+        missing = target_size - await redis_client.zcard(THREAD_POOL_KEY)
+        if missing <= 0:
+            return 0
+
+        semaphore = asyncio.Semaphore(THREAD_POOL_CREATE_CONCURRENCY)
+
+        async def create_thread() -> str:
+            async with semaphore:
+                await openai_rate_limiter.acquire("create_thread")
+                thread = await self.openai_client.beta.threads.create()
+                return thread.id
+
+        results = await asyncio.gather(*[create_thread() for _ in range(missing)], return_exceptions=True)
+
+        # Threads created before a failure are still pooled, otherwise they would leak
+        thread_ids = [result for result in results if isinstance(result, str)]
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            activity.logger.warning(f"Failed to create {len(errors)} pooled threads: {errors[0]!r}")
+        if not thread_ids:
+            raise errors[0]
+
+        expires_at = time.time() + THREAD_POOL_TTL_SECONDS
+        await redis_client.zadd(THREAD_POOL_KEY, {thread_id: expires_at for thread_id in thread_ids})
+        await redis_client.expire(THREAD_POOL_KEY, THREAD_POOL_TTL_SECONDS)
+
+        activity.logger.info(f"Added {len(thread_ids)} threads to the pool")
+
+        return len(thread_ids)
@@ -1,17 +1,29 @@
 import os
 import asyncio
-import redis.asyncio as redis
 from openai import AsyncAssistantEventHandler, AsyncOpenAI, OpenAI
 from literalai.helper import utc_now
 import chainlit as cl
 from chainlit.config import config
+from chainlit.data import get_data_layer
 import json
+import time
 from functions.common import process_function_calls
-from temporalio.client import Client
+from temporalio.client import Client, WorkflowExecutionStatus
+from temporalio.service import RPCError, RPCStatusCode
 from dotenv import load_dotenv
 import uuid
 
-from workflows.conversation_thread_workflow import ConversationThreadWorkflow, ConversationThreadParams
+from activities.thread_pool_activities import THREAD_POOL_SIZE
+from assistants.assistant_cache import AssistantCache
+from clients.payload_codec import get_data_converter
+from streaming.codec import SUPPORTED_WIRE_FORMATS
+from streaming.coalescer import TokenCoalescer
+from streaming.subscriber import UNSUBSCRIBED, StreamCursor, reply_subscriber
+from telemetry.interceptors import get_interceptors
+from telemetry.metrics import IN_FLIGHT_REPLIES, IN_FLIGHT_SESSIONS, PUBLISH_TO_DELIVER, TIME_TO_FIRST_TOKEN, start_metrics_server
+from telemetry.tracing import start_span
+from workers.pools import WORKFLOW_TASK_QUEUE
+from workflows.conversation_thread_workflow import ConversationInput, ConversationThreadWorkflow, ConversationThreadParams, HistoryPageRequest
 
 load_dotenv()
 
@@ -19,81 +31,171 @@ openai_api_key = os.getenv("OPENAI_API_KEY")
 openai_assistant_id = os.getenv("OPENAI_ASSISTANT_ID")
 openai_gateway_url = os.getenv("OPENAI_GATEWAY_URL")
 
-REDIS_HOST = os.getenv("REDIS_HOST")
-REDIS_PORT = os.getenv("REDIS_PORT")
-
 TEMPORAL_HOST = os.getenv("TEMPORAL_HOST")
 TEMPORAL_PORT = os.getenv("TEMPORAL_PORT")
 
-
-sync_openai_client = OpenAI(api_key=openai_api_key, base_url=openai_gateway_url)
-
-assistant = sync_openai_client.beta.assistants.retrieve(
-    assistant_id=openai_assistant_id
-)
-
-config.ui.name = assistant.name
+# Conversations continue as new past this many history events, keeping the latest messages
+CONVERSATION_MAX_HISTORY_LENGTH = int(os.getenv("CONVERSATION_MAX_HISTORY_LENGTH", "2000"))
+CONVERSATION_HISTORY_TAIL_SIZE = int(os.getenv("CONVERSATION_HISTORY_TAIL_SIZE", "20"))
+# Idle conversations are closed by their workflow, e.g. when the browser went away without ending the chat
+CONVERSATION_IDLE_TIMEOUT_SECONDS = int(os.getenv("CONVERSATION_IDLE_TIMEOUT_SECONDS", "1800"))
+CONVERSATION_DELETE_THREAD_ON_CLOSE = os.getenv("CONVERSATION_DELETE_THREAD_ON_CLOSE", "false").lower() == "true"
+# Messages sent within this window are answered together, at the cost of this much extra latency
+CONVERSATION_COALESCE_WINDOW_MS = int(os.getenv("CONVERSATION_COALESCE_WINDOW_MS", "200"))
+# Keep conversations running when the browser disconnects so they can be resumed, on by
+# default when Chainlit data persistence (needed for on_chat_resume) is configured
+CONVERSATION_KEEP_ON_DISCONNECT = os.getenv("CONVERSATION_KEEP_ON_DISCONNECT", "")
+# Messages fetched per history query when a chat is resumed
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+
+openai_client = AsyncOpenAI(api_key=openai_api_key, base_url=openai_gateway_url)
+
+# Assistant metadata is fetched lazily and shared with the worker through redis
+assistant_cache = AssistantCache(openai_client)
 
 temporal_client: Client = None
 
-redis_client = redis.from_url(
-  'redis://' + REDIS_HOST + ':' + REDIS_PORT,
-  health_check_interval=10,
-  socket_connect_timeout=5,
-  retry_on_timeout=True,
-  socket_keepalive=True
-)
+start_metrics_server()
 
 
 async def get_temporal_client() -> Client:
     global temporal_client
     if not temporal_client:
-        temporal_client = await Client.connect(TEMPORAL_HOST + ":" + TEMPORAL_PORT)
+        temporal_client = await Client.connect(
+            TEMPORAL_HOST + ":" + TEMPORAL_PORT,
+            interceptors=get_interceptors(),
+            data_converter=get_data_converter(),
+        )
     return temporal_client
 
 def get_workflow_id(session: dict):
-    return session.get("id", None)
+    # Chainlit owns "id" and resets it to the per-connection session id
+    return session.get("workflow_id", None)
+
+def keep_on_disconnect() -> bool:
+    if CONVERSATION_KEEP_ON_DISCONNECT:
+        return CONVERSATION_KEEP_ON_DISCONNECT.lower() == "true"
+    return get_data_layer() is not None
+
+def conversation_workflow_id(chainlit_thread_id: str) -> str:
+    """
+    Stable per Chainlit thread, so a resumed chat finds its workflow again.
+    """
+    return "conversation-" + chainlit_thread_id
+
+async def start_conversation(client: Client, workflow_id: str):
+    handle = await client.start_workflow(
+        ConversationThreadWorkflow.run,
+        ConversationThreadParams(
+            remote_ip_address="40.40.40.40", # random ip, TODO: add code to get client ip address
+            wire_formats=SUPPORTED_WIRE_FORMATS,
+            max_history_length=CONVERSATION_MAX_HISTORY_LENGTH,
+            history_tail_size=CONVERSATION_HISTORY_TAIL_SIZE,
+            idle_timeout_seconds=CONVERSATION_IDLE_TIMEOUT_SECONDS,
+            delete_thread_on_close=CONVERSATION_DELETE_THREAD_ON_CLOSE,
+            coalesce_window_ms=CONVERSATION_COALESCE_WINDOW_MS,
+            use_thread_pool=THREAD_POOL_SIZE > 0,
+        ),
+        id=workflow_id,
+        task_queue=WORKFLOW_TASK_QUEUE,
+    )
+
+    # Returns as soon as the workflow has created the thread, no polling needed
+    thread_id = await handle.execute_update(ConversationThreadWorkflow.wait_until_ready)
+
+    # Store thread ID in user session for later use
+    cl.user_session.set("thread_id", thread_id)
+    cl.user_session.set("history_offset", 0)
+
+    IN_FLIGHT_SESSIONS.inc()
+
+def reset_stream_state():
+    """
+    Forgets the replies of a previous conversation, its stream offsets do not apply anymore.
+    """
+    cl.user_session.set("reply_streaming", False)
+    cl.user_session.set("waiting_replies", {})
+    cl.user_session.set("stream_cursor", StreamCursor())
 
 @cl.on_chat_start
 async def start_chat():
-    client = await get_temporal_client()
+    # Registered before the first await, messages sent meanwhile wait for the conversation
+    ready = asyncio.Event()
+    cl.user_session.set("conversation_ready", ready)
+    try:
+        client = await get_temporal_client()
 
-    cl.user_session.set("id", str(uuid.uuid4()))
+        assistant = await assistant_cache.get(openai_assistant_id)
+        config.ui.name = assistant.name
 
-    workflow_id =  get_workflow_id(cl.user_session)
+        cl.user_session.set("workflow_id", conversation_workflow_id(cl.context.session.thread_id))
 
-    handle = client.get_workflow_handle(
-        workflow_id=workflow_id,
-    )
+        workflow_id =  get_workflow_id(cl.user_session)
 
-    start_new_workflow: bool = False
+        await start_conversation(client, workflow_id)
+    finally:
+        ready.set()
+
+@cl.on_chat_resume
+async def resume_chat(thread: dict):
+    """
+    Reattaches to the running workflow of the thread and shows the messages the UI does not
+    have yet, all from workflow state. Starts a new conversation when the old one was closed.
+    """
+    ready = asyncio.Event()
+    cl.user_session.set("conversation_ready", ready)
     try:
-        workflow_status = await handle.describe()
+        # The restored session may have been saved mid-reply, its streaming state is stale
+        reset_stream_state()
 
-        if workflow_status.status != 1:
-            start_new_workflow = True
-    except Exception as e:
-        start_new_workflow = True
-
-    if start_new_workflow:
-        handle = await client.start_workflow(
-            ConversationThreadWorkflow.run,
-            ConversationThreadParams(
-                remote_ip_address="40.40.40.40" # random ip, TODO: add code to get client ip address
-            ),
-            id=workflow_id,
-            task_queue="conversation-workflow-task-queue",
-        )
+        client = await get_temporal_client()
+
+        assistant = await assistant_cache.get(openai_assistant_id)
+        config.ui.name = assistant.name
+
+        cl.user_session.set("workflow_id", conversation_workflow_id(thread["id"]))
+
+        workflow_id = get_workflow_id(cl.user_session)
+        handle = client.get_workflow_handle(workflow_id=workflow_id)
 
-    thread_id = None
+        try:
+            description = await handle.describe()
+            running = description.status == WorkflowExecutionStatus.RUNNING
+        except RPCError:
+            running = False
+
+        if not running:
+            await start_conversation(client, workflow_id)
+            return
 
-    while(not thread_id):
         thread_id = await handle.query(ConversationThreadWorkflow.get_thread_id)
-        await asyncio.sleep(1)
+        cl.user_session.set("thread_id", thread_id)
+
+        IN_FLIGHT_SESSIONS.inc()
+    finally:
+        ready.set()
+
+    # Restored from the thread metadata, the UI shows the conversation up to there. Chainlit
+    # messages do not map one to one to workflow messages, e.g. error or partial replies
+    offset = cl.user_session.get("history_offset")
+    if offset is None:
+        offset = len([step for step in thread.get("steps") or [] if step.get("type") in ("user_message", "assistant_message")])
+    while True:
+        page = await handle.query(
+            ConversationThreadWorkflow.get_history_page,
+            HistoryPageRequest(offset=offset, limit=HISTORY_PAGE_SIZE),
+        )
 
-    # Store thread ID in user session for later use
-    cl.user_session.set("thread_id", thread_id)
+        for message in page.messages:
+            if message.author == "assistant":
+                await cl.Message(author=assistant.name, content=message.message).send()
+            else:
+                await cl.Message(author="User", content=message.message, type="user_message").send()
 
+        cl.user_session.set("history_offset", page.next_offset)
+        if not page.messages or page.next_offset >= page.total:
+            break
+        offset = page.next_offset
 
 
 @cl.on_message
@@ -101,40 +203,155 @@ async def main(message: cl.Message):
     try:
         client = await get_temporal_client()
 
+        # Messages sent right after connecting wait for the conversation to start
+        ready = cl.user_session.get("conversation_ready")
+        if ready is not None:
+            await ready.wait()
+
         workflow_id =  get_workflow_id(cl.user_session)
 
         handle = client.get_workflow_handle(
             workflow_id=workflow_id,
         )
 
-        thread_id = await handle.query(ConversationThreadWorkflow.get_thread_id)
+        thread_id = cl.user_session.get("thread_id")
+
+        assistant = await assistant_cache.get(openai_assistant_id)
+
+        with start_span("chat.on_message", workflow_id=workflow_id, thread_id=thread_id):
+            try:
+                await stream_reply(handle, thread_id, message.content, assistant.name)
+            except RPCError as e:
+                if e.status != RPCStatusCode.NOT_FOUND:
+                    raise
+
+                # The workflow closed itself after being idle, the chat goes on in a new conversation
+                IN_FLIGHT_SESSIONS.dec()
+                reset_stream_state()
+                await start_conversation(client, workflow_id)
+                thread_id = cl.user_session.get("thread_id")
+                await stream_reply(handle, thread_id, message.content, assistant.name)
+
+    except Exception as e:
+        print("An error occurred:", str(e))
+        await cl.Message("An error occurred. Please refresh the page and try again.").send()
+
 
-        async with redis_client.pubsub() as pubsub:
-            await pubsub.subscribe(thread_id)
+async def stream_reply(handle, thread_id: str, content: str, author: str):
+    """
+    Signals the user message to the workflow and streams the reply events into Chainlit messages.
 
-            await handle.signal(ConversationThreadWorkflow.on_message, message.content)
+    The workflow answers a burst of messages with a single reply, so only one handler per
+    session streams replies. Handlers of messages sent meanwhile wait until the end of the
+    reply that answered their message is streamed.
+    """
+    started_at = time.perf_counter()
+    first_token_received = False
 
-            cl_message = None
-            while True:
-                message = await pubsub.get_message(ignore_subscribe_messages=True)
-                if message is not None:
-                    message_dict = json.loads(message["data"].decode())
+    message_id = str(uuid.uuid4())
+    waiting_replies: dict = cl.user_session.get("waiting_replies") or {}
+    cl.user_session.set("waiting_replies", waiting_replies)
 
-                    if(message_dict["e"] == "on_text_created"):
+    reply = asyncio.get_running_loop().create_future()
+    waiting_replies[message_id] = reply
+
+    if cl.user_session.get("reply_streaming"):
+        try:
+            await handle.signal(ConversationThreadWorkflow.on_message, ConversationInput(message=content, message_id=message_id))
+            await reply
+        finally:
+            waiting_replies.pop(message_id, None)
+        return
+
+    cursor: StreamCursor = cl.user_session.get("stream_cursor") or StreamCursor()
+    cl.user_session.set("stream_cursor", cursor)
+
+    cl.user_session.set("reply_streaming", True)
+    IN_FLIGHT_REPLIES.inc()
+    queue = await reply_subscriber.subscribe(thread_id, cursor.offset)
+    try:
+        await handle.signal(ConversationThreadWorkflow.on_message, ConversationInput(message=content, message_id=message_id))
+
+        cl_message = None
+        coalescer = None
+        while waiting_replies:
+            item = await queue.get()
+            if item is UNSUBSCRIBED:
+                # The chat ended while the reply was streaming
+                break
+            offset, events = item
+
+            for message_dict in events:
+                # Replayed or re-delivered events of a run that was already shown
+                if not cursor.accept(offset, message_dict):
+                    continue
+
+                if "t" in message_dict:
+                    PUBLISH_TO_DELIVER.labels(message_dict["e"]).observe(max(0.0, time.time() - message_dict["t"]))
+
+                if(message_dict["e"] == "on_text_created"):
+                    if cl_message is None:
                         cl_message = await cl.Message(
-                            author=assistant.name, content=""
+                            author=author, content=""
                         ).send()
-                    elif(message_dict["e"] == "on_text_delta"):
-                        await cl_message.stream_token(message_dict["v"])
-                    elif(message_dict["e"] == "on_text_done"):
+                    else:
+                        # The activity was retried and streams the reply from the start again
+                        await coalescer.close()
+                        cl_message.content = ""
+                        await cl_message.update()
+                    coalescer = TokenCoalescer(cl_message)
+                elif(message_dict["e"] == "on_text_delta"):
+                    if coalescer is None:
+                        # Rest of a reply whose handler was stopped
+                        continue
+                    if not first_token_received:
+                        first_token_received = True
+                        TIME_TO_FIRST_TOKEN.labels("app").observe(time.perf_counter() - started_at)
+                    await coalescer.add(message_dict["v"])
+                elif(message_dict["e"] == "on_text_done"):
+                    if cl_message is not None:
+                        await coalescer.close()
+                        # The final text also covers deltas dropped for a slow session
+                        cl_message.content = message_dict["v"]
                         await cl_message.update()
-                        await pubsub.unsubscribe(thread_id)
-                        break
+                    cl_message = None
+                    coalescer = None
+                elif(message_dict["e"] == "on_reply_done"):
+                    # A reply can hold several texts, e.g. around tool calls, only this ends it
+                    reply_done = json.loads(message_dict["v"])
+                    if reply_done["failed"]:
+                        await cl.Message("An error occurred. Please try again.").send()
+
+                    cl.user_session.set("history_offset", reply_done["history_length"])
+
+                    for answered_id in reply_done["message_ids"]:
+                        answered_reply = waiting_replies.pop(answered_id, None)
+                        if answered_reply is not None and not answered_reply.done():
+                            answered_reply.set_result(None)
+    finally:
+        cl.user_session.set("reply_streaming", False)
+        IN_FLIGHT_REPLIES.dec()
+        await reply_subscriber.unsubscribe(thread_id)
+
+        # Nobody streams their replies anymore
+        for waiting_id, waiting_reply in list(waiting_replies.items()):
+            if waiting_id != message_id and not waiting_reply.done():
+                waiting_reply.set_exception(RuntimeError("Reply stream closed"))
+        waiting_replies.pop(message_id, None)
+
+
+@cl.on_stop
+async def stop_generating():
+    """
+    Chainlit cancels the message handler, the workflow cancels the OpenAI run.
+    """
+    client = await get_temporal_client()
 
+    handle = client.get_workflow_handle(
+        workflow_id=get_workflow_id(cl.user_session),
+    )
 
-    except Exception as e:
-        print("An error occurred:", str(e))
-        cl.Message("An error occurred. Please refresh the page and try again.")
+    await handle.signal(ConversationThreadWorkflow.stop_generating)
 
 
 @cl.on_chat_end
@@ -143,13 +360,25 @@ async def end_chat():
 
     workflow_id = get_workflow_id(cl.user_session)
 
-    #thread_id = cl.user_session.get("thread_id")
+    thread_id = cl.user_session.get("thread_id")
+    if thread_id:
+        await reply_subscriber.unsubscribe(thread_id)
+        IN_FLIGHT_SESSIONS.dec()
+
+    if keep_on_disconnect():
+        # The chat can still be resumed, the idle timeout closes it otherwise
+        print("Chat Detached")
+        return
 
     handle = client.get_workflow_handle(
         workflow_id=workflow_id,
     )
 
-    await handle.signal(ConversationThreadWorkflow.end_thread)
+    try:
+        await handle.signal(ConversationThreadWorkflow.end_thread)
+    except RPCError as e:
+        # The workflow already closed itself after being idle
+        print("Failed to end thread:", str(e))
 
     #cl.user_session.clear()
 
@@ -0,0 +1,94 @@
+import asyncio
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional, Tuple
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+from clients.redis_client import get_redis_client
+
+load_dotenv()
+
+# Shared copy in redis, refreshed from OpenAI when it expires or is invalidated
+ASSISTANT_CACHE_TTL_SECONDS = int(os.getenv("ASSISTANT_CACHE_TTL_SECONDS", "300"))
+# Per-process copy in front of redis, bounds how long an invalidation takes to reach every process
+ASSISTANT_CACHE_LOCAL_TTL_SECONDS = int(os.getenv("ASSISTANT_CACHE_LOCAL_TTL_SECONDS", "30"))
+
+
+@dataclass
+class AssistantInfo:
+    id: str
+    name: str
+    model: str = ""
+
+
+def assistant_cache_key(assistant_id: str) -> str:
+    return "assistant:" + assistant_id
+
+
+class AssistantCache:
+    """
+    TTL cache of assistant metadata shared by the app and the worker.
+
+    Lookups hit a short-lived in-process copy first, then the shared redis copy, and
+    only retrieve the assistant from OpenAI when both are missing. Concurrent lookups
+    of the same assistant share one retrieval.
+    """
+    def __init__(
+        self,
+        openai_client: AsyncOpenAI,
+        ttl_seconds: int = ASSISTANT_CACHE_TTL_SECONDS,
+        local_ttl_seconds: int = ASSISTANT_CACHE_LOCAL_TTL_SECONDS,
+    ) -> None:
+        self.openai_client = openai_client
+        self.ttl_seconds = ttl_seconds
+        self.local_ttl_seconds = local_ttl_seconds
+        self.entries: Dict[str, Tuple[float, AssistantInfo]] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    async def get(self, assistant_id: str) -> AssistantInfo:
+        assistant = self._get_local(assistant_id)
+        if assistant is not None:
+            return assistant
+
+        async with self.locks.setdefault(assistant_id, asyncio.Lock()):
+            assistant = self._get_local(assistant_id)
+            if assistant is not None:
+                return assistant
+
+            redis_client = get_redis_client()
+
+            cached = await redis_client.get(assistant_cache_key(assistant_id))
+            if cached is not None:
+                assistant = AssistantInfo(**json.loads(cached))
+            else:
+                retrieved = await self.openai_client.beta.assistants.retrieve(assistant_id=assistant_id)
+                assistant = AssistantInfo(id=retrieved.id, name=retrieved.name or "", model=retrieved.model)
+                await redis_client.set(
+                    assistant_cache_key(assistant_id),
+                    json.dumps(asdict(assistant)),
+                    ex=self.ttl_seconds,
+                )
+
+            self.entries[assistant_id] = (time.monotonic() + self.local_ttl_seconds, assistant)
+
+            return assistant
+
+    async def invalidate(self, assistant_id: Optional[str] = None) -> None:
+        """
+        Drops one assistant, or every assistant known to this process, from both tiers.
+        """
+        assistant_ids = [assistant_id] if assistant_id else list(self.entries.keys())
+
+        for key in assistant_ids:
+            self.entries.pop(key, None)
+
+        if assistant_ids:
+            await get_redis_client().delete(*[assistant_cache_key(key) for key in assistant_ids])
+
+    def _get_local(self, assistant_id: str) -> Optional[AssistantInfo]:
+        entry = self.entries.get(assistant_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
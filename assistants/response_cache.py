@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import os
+import re
+import time
+from typing import Optional
+from dotenv import load_dotenv
+from clients.redis_client import get_redis_client
+
+load_dotenv()
+
+# Opt-in, replies are reused verbatim for every user asking the same question in the same context
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+
+RESPONSE_CACHE_KEY = "response-cache"
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Case, surrounding whitespace, repeated whitespace and trailing punctuation are ignored.
+    """
+    return re.sub(r"\s+", " ", prompt).strip().rstrip("?!. ").lower()
+
+
+class ResponseCache:
+    """
+    Exact-match cache of assistant replies in redis.
+
+    Entries are keyed by assistant, normalized prompt and a fingerprint of the context the
+    reply depends on, and expire after `ttl_seconds`. An index sorted by last use caps the
+    number of entries, the least recently used ones are evicted first.
+    """
+    def __init__(
+        self,
+        enabled: bool = RESPONSE_CACHE_ENABLED,
+        ttl_seconds: int = RESPONSE_CACHE_TTL_SECONDS,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+    ) -> None:
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.index_key = RESPONSE_CACHE_KEY + ":index"
+
+    def key(self, assistant_id: str, prompt: str, context: str) -> str:
+        digest = hashlib.sha1(f"{normalize_prompt(prompt)}\n{context}".encode()).hexdigest()
+        return f"{RESPONSE_CACHE_KEY}:{assistant_id}:{digest}"
+
+    async def get(self, assistant_id: str, prompt: str, context: str) -> Optional[str]:
+        if not self.enabled or not prompt:
+            return None
+
+        key = self.key(assistant_id, prompt, context)
+        try:
+            async with get_redis_client().pipeline(transaction=False) as pipe:
+                pipe.get(key)
+                pipe.zadd(self.index_key, {key: time.time()}, xx=True)
+                reply, _ = await pipe.execute()
+        except Exception:
+            # The cache is an optimization, replies are generated without it
+            logger.exception("Failed to read response cache")
+            return None
+
+        return reply.decode() if reply is not None else None
+
+    async def set(self, assistant_id: str, prompt: str, context: str, reply: str) -> None:
+        if not self.enabled or not prompt or not reply:
+            return
+
+        key = self.key(assistant_id, prompt, context)
+        redis_client = get_redis_client()
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.set(key, reply, ex=self.ttl_seconds)
+                pipe.zadd(self.index_key, {key: time.time()})
+                # Expired entries linger in the index until they are evicted
+                pipe.zremrangebyscore(self.index_key, "-inf", time.time() - self.ttl_seconds)
+                pipe.zcard(self.index_key)
+                size = (await pipe.execute())[-1]
+
+            if size > self.max_entries:
+                evicted = await redis_client.zpopmin(self.index_key, size - self.max_entries)
+                if evicted:
+                    await redis_client.delete(*[evicted_key for evicted_key, _ in evicted])
+        except Exception:
+            logger.exception("Failed to write response cache")
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,302 @@
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Optional
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+WORDS = (
+    "the weather today is mild with a light breeze from the west and a few clouds "
+    "expected later in the afternoon temperatures will stay around fifteen degrees "
+    "so a light jacket should be enough if you are heading outside this evening"
+).split()
+
+
+@dataclass
+class FakeOpenAIConfig:
+    # Streaming rate of reply tokens once the first token was sent
+    tokens_per_second: float = 50.0
+    tokens_per_reply: int = 60
+    # Delay before the first token of a run, models the model's prompt processing
+    first_token_latency_ms: int = 300
+    # Delay of every non-streaming call (threads, messages, assistants)
+    api_latency_ms: int = 20
+    # Share of runs that ask for a get_weather call before replying
+    tool_call_probability: float = 0.0
+    seed: Optional[int] = None
+
+
+def new_id(prefix: str) -> str:
+    return prefix + "_" + uuid.uuid4().hex[:24]
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class FakeOpenAI:
+    """
+    Local stand-in for the parts of the OpenAI Assistants API this repo uses.
+
+    Runs are streamed as server-sent events in the same shape as the real API, so the
+    unmodified SDK event handler drives the activities. The geocoding, forecast and IP
+    lookup endpoints used by the tools are served as well, so a benchmark never leaves
+    the machine.
+    """
+    def __init__(self, config: FakeOpenAIConfig) -> None:
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.runs: Dict[str, dict] = {}
+
+    def app(self) -> Starlette:
+        return Starlette(routes=[
+            Route("/v1/assistants/{assistant_id}", self.retrieve_assistant, methods=["GET"]),
+            Route("/v1/threads", self.create_thread, methods=["POST"]),
+            Route("/v1/threads/{thread_id}", self.delete_thread, methods=["DELETE"]),
+            Route("/v1/threads/{thread_id}/messages", self.create_message, methods=["POST"]),
+            Route("/v1/threads/{thread_id}/runs", self.create_run, methods=["POST"]),
+            Route("/v1/threads/{thread_id}/runs/{run_id}/submit_tool_outputs", self.submit_tool_outputs, methods=["POST"]),
+            Route("/v1/threads/{thread_id}/runs/{run_id}/cancel", self.cancel_run, methods=["POST"]),
+            Route("/geo/search", self.geocoding, methods=["GET"]),
+            Route("/weather/forecast", self.forecast, methods=["GET"]),
+            Route("/ip/{ip}", self.ip_lookup, methods=["GET"]),
+        ])
+
+    async def retrieve_assistant(self, request: Request) -> JSONResponse:
+        await self._api_latency()
+        return JSONResponse({
+            "id": request.path_params["assistant_id"],
+            "object": "assistant",
+            "created_at": int(time.time()),
+            "name": "Benchmark Assistant",
+            "description": None,
+            "model": "fake-model",
+            "instructions": "",
+            "tools": [],
+            "metadata": {},
+        })
+
+    async def create_thread(self, request: Request) -> JSONResponse:
+        await self._api_latency()
+        return JSONResponse({
+            "id": new_id("thread"),
+            "object": "thread",
+            "created_at": int(time.time()),
+            "metadata": {},
+            "tool_resources": None,
+        })
+
+    async def delete_thread(self, request: Request) -> JSONResponse:
+        await self._api_latency()
+        return JSONResponse({"id": request.path_params["thread_id"], "object": "thread.deleted", "deleted": True})
+
+    async def create_message(self, request: Request) -> JSONResponse:
+        await self._api_latency()
+        body = await request.json()
+        return JSONResponse(self._message(
+            request.path_params["thread_id"],
+            role=body.get("role", "user"),
+            text=body.get("content", ""),
+            status="completed",
+        ))
+
+    async def create_run(self, request: Request) -> StreamingResponse:
+        body = await request.json()
+        run = self._run(request.path_params["thread_id"], body.get("assistant_id", ""))
+        self.runs[run["id"]] = run
+
+        return StreamingResponse(self._stream_run(run), media_type="text/event-stream")
+
+    async def submit_tool_outputs(self, request: Request) -> StreamingResponse:
+        run = self.runs[request.path_params["run_id"]]
+        run["required_action"] = None
+
+        return StreamingResponse(self._stream_reply(run), media_type="text/event-stream")
+
+    async def cancel_run(self, request: Request) -> JSONResponse:
+        await self._api_latency()
+        run = self.runs.get(request.path_params["run_id"]) or self._run(request.path_params["thread_id"], "")
+        run["status"] = "cancelling"
+        return JSONResponse(run)
+
+    async def geocoding(self, request: Request) -> JSONResponse:
+        await self._api_latency()
+        return JSONResponse({"results": [{"name": request.query_params.get("name", ""), "latitude": 52.52, "longitude": 13.41}]})
+
+    async def forecast(self, request: Request) -> JSONResponse:
+        await self._api_latency()
+        return JSONResponse({
+            "latitude": float(request.query_params.get("latitude", 0)),
+            "longitude": float(request.query_params.get("longitude", 0)),
+            "hourly_units": {"time": "iso8601", "temperature_2m": "°C"},
+            "hourly": {
+                "time": [f"2024-01-01T{hour:02d}:00" for hour in range(24)],
+                "temperature_2m": [round(10 + self.random.random() * 5, 1) for _ in range(24)],
+            },
+        })
+
+    async def ip_lookup(self, request: Request) -> JSONResponse:
+        await self._api_latency()
+        return JSONResponse({"status": "success", "city": "Berlin", "query": request.path_params["ip"]})
+
+    async def _stream_run(self, run: dict) -> AsyncIterator[str]:
+        yield sse("thread.run.created", run)
+        run["status"] = "in_progress"
+        yield sse("thread.run.in_progress", run)
+
+        if self.random.random() >= self.config.tool_call_probability:
+            async for event in self._stream_reply(run):
+                yield event
+            return
+
+        await asyncio.sleep(self.config.first_token_latency_ms / 1000)
+
+        call_id = new_id("call")
+        function = {"name": "get_weather", "arguments": json.dumps({"location": "Berlin", "unit": "c"})}
+
+        step = self._step(run, "tool_calls", {"type": "tool_calls", "tool_calls": []})
+        yield sse("thread.run.step.created", step)
+        yield sse("thread.run.step.in_progress", step)
+        yield sse("thread.run.step.delta", {
+            "id": step["id"],
+            "object": "thread.run.step.delta",
+            "delta": {
+                "step_details": {
+                    "type": "tool_calls",
+                    "tool_calls": [{"index": 0, "id": call_id, "type": "function", "function": {**function, "output": None}}],
+                },
+            },
+        })
+
+        run["status"] = "requires_action"
+        run["required_action"] = {
+            "type": "submit_tool_outputs",
+            "submit_tool_outputs": {"tool_calls": [{"id": call_id, "type": "function", "function": function}]},
+        }
+        yield sse("thread.run.requires_action", run)
+        yield "event: done\ndata: [DONE]\n\n"
+
+    async def _stream_reply(self, run: dict) -> AsyncIterator[str]:
+        run["status"] = "in_progress"
+
+        message = self._message(run["thread_id"], role="assistant", text=None, status="in_progress", run=run)
+        step = self._step(run, "message_creation", {"type": "message_creation", "message_creation": {"message_id": message["id"]}})
+        yield sse("thread.run.step.created", step)
+        yield sse("thread.message.created", message)
+        yield sse("thread.message.in_progress", message)
+
+        await asyncio.sleep(self.config.first_token_latency_ms / 1000)
+
+        tokens = []
+        for index in range(self.config.tokens_per_reply):
+            if run["status"] == "cancelling":
+                break
+
+            token = ("" if index == 0 else " ") + WORDS[index % len(WORDS)]
+            tokens.append(token)
+            yield sse("thread.message.delta", {
+                "id": message["id"],
+                "object": "thread.message.delta",
+                "delta": {"content": [{"index": 0, "type": "text", "text": {"value": token, "annotations": []}}]},
+            })
+            await asyncio.sleep(1 / self.config.tokens_per_second)
+
+        message["status"] = "completed"
+        message["content"] = [{"type": "text", "text": {"value": "".join(tokens), "annotations": []}}]
+        yield sse("thread.message.completed", message)
+
+        step["status"] = "completed"
+        yield sse("thread.run.step.completed", step)
+
+        if run["status"] == "cancelling":
+            run["status"] = "cancelled"
+            yield sse("thread.run.cancelled", run)
+        else:
+            run["status"] = "completed"
+            run["usage"] = {
+                "prompt_tokens": 200,
+                "completion_tokens": len(tokens),
+                "total_tokens": 200 + len(tokens),
+            }
+            yield sse("thread.run.completed", run)
+
+        yield "event: done\ndata: [DONE]\n\n"
+
+    def _run(self, thread_id: str, assistant_id: str) -> dict:
+        return {
+            "id": new_id("run"),
+            "object": "thread.run",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "assistant_id": assistant_id,
+            "status": "queued",
+            "required_action": None,
+            "last_error": None,
+            "expires_at": None,
+            "started_at": int(time.time()),
+            "cancelled_at": None,
+            "failed_at": None,
+            "completed_at": None,
+            "incomplete_details": None,
+            "model": "fake-model",
+            "instructions": "",
+            "tools": [],
+            "metadata": {},
+            "usage": None,
+            "temperature": 1.0,
+            "top_p": 1.0,
+            "max_prompt_tokens": None,
+            "max_completion_tokens": None,
+            "truncation_strategy": {"type": "auto", "last_messages": None},
+            "response_format": "auto",
+            "tool_choice": "auto",
+            "parallel_tool_calls": True,
+        }
+
+    def _step(self, run: dict, step_type: str, step_details: dict) -> dict:
+        return {
+            "id": new_id("step"),
+            "object": "thread.run.step",
+            "created_at": int(time.time()),
+            "run_id": run["id"],
+            "assistant_id": run["assistant_id"],
+            "thread_id": run["thread_id"],
+            "type": step_type,
+            "status": "in_progress",
+            "step_details": step_details,
+            "last_error": None,
+            "expired_at": None,
+            "cancelled_at": None,
+            "failed_at": None,
+            "completed_at": None,
+            "metadata": None,
+            "usage": None,
+        }
+
+    def _message(self, thread_id: str, role: str, text: Optional[str], status: str, run: Optional[dict] = None) -> dict:
+        return {
+            "id": new_id("msg"),
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "content": [] if text is None else [{"type": "text", "text": {"value": text, "annotations": []}}],
+            "assistant_id": run["assistant_id"] if run else None,
+            "run_id": run["id"] if run else None,
+            "status": status,
+            "attachments": [],
+            "metadata": {},
+            "completed_at": None,
+            "incomplete_at": None,
+            "incomplete_details": None,
+        }
+
+    async def _api_latency(self) -> None:
+        await asyncio.sleep(self.config.api_latency_ms / 1000)
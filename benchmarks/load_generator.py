@@ -0,0 +1,394 @@
+"""
+Concurrent-session load generator for the Chainlit front end.
+
+Opens simulated browser sessions against Chainlit's socket.io endpoint, sends user
+messages with think times drawn from a configurable arrival distribution and records
+time to first token, inter-token gaps and errors for every turn. Each concurrency level
+is one point of the latency-vs-concurrency curve used to pick autoscaling thresholds.
+
+Against the docker compose stack (or any deployed app):
+
+    python -m benchmarks.load_generator --url http://localhost:8000 --concurrency 10,50,100 --turns 5
+
+Against an in-process stack of FakeOpenAI, a local Temporal dev server, the workers and
+the Chainlit server:
+
+    python -m benchmarks.load_generator --local --fakeredis --concurrency 10,50,100 --csv curve.csv
+"""
+import argparse
+import asyncio
+import contextlib
+import csv
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import socketio
+import uvicorn
+
+from benchmarks.fake_openai import FakeOpenAI, FakeOpenAIConfig
+from benchmarks.run_benchmark import PROMPTS, configure_environment, count_tokens, free_port, percentile, use_fakeredis
+
+
+CHAINLIT_SOCKET_PATH = "/ws/socket.io"
+
+
+@dataclass
+class TurnResult:
+    time_to_first_token: Optional[float] = None
+    duration: float = 0.0
+    tokens: int = 0
+    frames: int = 0
+    # Gaps between UI frames, set by the publisher and UI flush intervals
+    frame_gaps: List[float] = field(default_factory=list)
+    # Each frame gap spread over the tokens of the frame it ended with
+    inter_token_gaps: List[float] = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def jitter(self) -> Optional[float]:
+        """
+        Standard deviation of the gaps between streamed tokens.
+        """
+        if len(self.inter_token_gaps) < 2:
+            return None
+        return statistics.pstdev(self.inter_token_gaps)
+
+
+@dataclass
+class SessionResult:
+    connect_latency: float = 0.0
+    turns: List[TurnResult] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default="http://localhost:8000", help="Chainlit app to load")
+    target.add_argument("--local", action="store_true", help="Start FakeOpenAI, Temporal, the workers and Chainlit in this process")
+    parser.add_argument("--concurrency", default="1,10,50,100", help="Comma separated numbers of concurrent sessions")
+    parser.add_argument("--turns", type=int, default=3, help="User messages per session")
+    parser.add_argument("--arrival", choices=["constant", "exponential", "uniform"], default="exponential",
+                        help="Distribution of the think time before each message, exponential gives Poisson arrivals")
+    parser.add_argument("--think-time-ms", type=int, default=2000, help="Mean think time before each message")
+    parser.add_argument("--ramp-seconds", type=float, default=0.0, help="Spread the session starts of a level over this long")
+    parser.add_argument("--reply-timeout", type=float, default=120.0, help="Seconds after which a turn counts as failed")
+    parser.add_argument("--token", default=None, help="Access token when the app requires login")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=None, help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--csv", default=None, help="Also write the latency-vs-concurrency curve as CSV")
+
+    local = parser.add_argument_group("local stack")
+    local.add_argument("--fakeredis", action="store_true", help="Use an in-process fakeredis instead of REDIS_HOST/REDIS_PORT")
+    local.add_argument("--tokens-per-second", type=float, default=50.0)
+    local.add_argument("--tokens-per-reply", type=int, default=60)
+    local.add_argument("--first-token-latency-ms", type=int, default=300)
+    local.add_argument("--api-latency-ms", type=int, default=20)
+    local.add_argument("--tool-call-probability", type=float, default=0.0)
+    return parser.parse_args(argv)
+
+
+def think_time(arrival: str, mean: float, rng: random.Random) -> float:
+    if mean <= 0:
+        return 0.0
+    if arrival == "exponential":
+        return rng.expovariate(1 / mean)
+    if arrival == "uniform":
+        return rng.uniform(0, 2 * mean)
+    return mean
+
+
+class ChainlitSession:
+    """
+    One browser tab, speaking the same socket.io protocol as the Chainlit web client.
+    """
+    def __init__(self, url: str, token: Optional[str] = None) -> None:
+        self.url = url
+        self.session_id = str(uuid.uuid4())
+        self.thread_id = str(uuid.uuid4())
+        self.token = token
+        self.client = socketio.AsyncClient(reconnection=False)
+        self.frames: List[Tuple[float, int]] = []
+        self.task_ended = asyncio.Event()
+        self.disconnected = asyncio.Event()
+
+        self.client.on("stream_token", self.on_stream_token)
+        self.client.on("task_end", self.on_task_end)
+        self.client.on("disconnect", self.on_disconnect)
+
+    async def on_stream_token(self, data) -> None:
+        self.frames.append((time.perf_counter(), count_tokens(data.get("token", ""))))
+
+    async def on_task_end(self, data=None) -> None:
+        self.task_ended.set()
+
+    async def on_disconnect(self, *args) -> None:
+        self.disconnected.set()
+        self.task_ended.set()
+
+    async def connect(self, timeout: float) -> None:
+        headers = {
+            "X-Chainlit-Client-Type": "webapp",
+            "X-Chainlit-Session-Id": self.session_id,
+            "X-Chainlit-Thread-Id": self.thread_id,
+            "user-env": "{}",
+        }
+        if self.token:
+            headers["Authorization"] = "Bearer " + self.token
+
+        # Newer Chainlit versions read the session from the auth payload instead of headers
+        auth = {
+            "clientType": "webapp",
+            "sessionId": self.session_id,
+            "threadId": self.thread_id,
+            "userEnv": "{}",
+        }
+
+        self.task_ended.clear()
+        await self.client.connect(
+            self.url,
+            headers=headers,
+            auth=auth,
+            socketio_path=CHAINLIT_SOCKET_PATH,
+            transports=["websocket"],
+            wait_timeout=int(timeout),
+        )
+        # The server acknowledges with task_end before running on_chat_start
+        await self.client.emit("connection_successful")
+        await asyncio.wait_for(self.task_ended.wait(), timeout)
+
+    async def send(self, content: str, timeout: float) -> TurnResult:
+        self.frames = []
+        self.task_ended.clear()
+
+        started_at = time.perf_counter()
+        await self.client.emit("ui_message", {
+            "message": {
+                "id": str(uuid.uuid4()),
+                "threadId": self.thread_id,
+                "name": "User",
+                "type": "user_message",
+                "output": content,
+                "createdAt": datetime.now(timezone.utc).isoformat(),
+            },
+            "fileReferences": None,
+        })
+
+        result = TurnResult()
+        try:
+            await asyncio.wait_for(self.task_ended.wait(), timeout)
+        except asyncio.TimeoutError:
+            result.error = "timeout"
+        result.duration = time.perf_counter() - started_at
+
+        frames = list(self.frames)
+        result.tokens = sum(tokens for _, tokens in frames)
+        result.frames = len(frames)
+        if self.disconnected.is_set():
+            result.error = "disconnected"
+        elif frames:
+            result.time_to_first_token = frames[0][0] - started_at
+            for (earlier, _), (later, tokens) in zip(frames, frames[1:]):
+                result.frame_gaps.append(later - earlier)
+                if tokens:
+                    result.inter_token_gaps.extend([(later - earlier) / tokens] * tokens)
+        elif result.error is None:
+            # The app reports errors to the user instead of streaming a reply
+            result.error = "no tokens received"
+
+        return result
+
+    async def close(self) -> None:
+        with contextlib.suppress(Exception):
+            await self.client.disconnect()
+
+
+async def run_session(url: str, args: argparse.Namespace, start_delay: float, rng: random.Random) -> SessionResult:
+    await asyncio.sleep(start_delay)
+
+    session = ChainlitSession(url, args.token)
+    result = SessionResult()
+
+    started_at = time.perf_counter()
+    try:
+        await session.connect(args.reply_timeout)
+    except Exception as e:
+        result.error = repr(e)
+        await session.close()
+        return result
+    result.connect_latency = time.perf_counter() - started_at
+
+    try:
+        for turn in range(args.turns):
+            await asyncio.sleep(think_time(args.arrival, args.think_time_ms / 1000, rng))
+
+            turn_result = await session.send(PROMPTS[turn % len(PROMPTS)], args.reply_timeout)
+            result.turns.append(turn_result)
+            if turn_result.error == "disconnected":
+                result.error = "disconnected"
+                break
+    except Exception as e:
+        result.error = repr(e)
+    finally:
+        await session.close()
+
+    return result
+
+
+def summarize(concurrency: int, sessions: List[SessionResult], wall_time: float) -> dict:
+    turns = [turn for session in sessions for turn in session.turns]
+    completed = [turn for turn in turns if turn.error is None]
+    ttft = [turn.time_to_first_token for turn in completed]
+    durations = [turn.duration for turn in completed]
+    gaps = [gap for turn in completed for gap in turn.inter_token_gaps]
+    frame_gaps = [gap for turn in completed for gap in turn.frame_gaps]
+    jitter = [turn.jitter for turn in completed if turn.jitter is not None]
+    connect_latencies = [session.connect_latency for session in sessions if session.error is None]
+    errors = {}
+    for error in [session.error for session in sessions] + [turn.error for turn in turns]:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+
+    return {
+        "concurrency": concurrency,
+        "sessions": len(sessions),
+        "session_errors": sum(1 for session in sessions if session.error is not None),
+        "turns": len(turns),
+        "turn_errors": len(turns) - len(completed),
+        "error_rate": (len(turns) - len(completed)) / len(turns) if turns else None,
+        "errors": errors,
+        "wall_time_seconds": wall_time,
+        "messages_per_second": len(turns) / wall_time if wall_time else None,
+        "connect_p50_seconds": percentile(connect_latencies, 50),
+        "connect_p99_seconds": percentile(connect_latencies, 99),
+        "time_to_first_token_p50_seconds": percentile(ttft, 50),
+        "time_to_first_token_p95_seconds": percentile(ttft, 95),
+        "time_to_first_token_p99_seconds": percentile(ttft, 99),
+        "inter_token_gap_p50_seconds": percentile(gaps, 50),
+        "inter_token_gap_p99_seconds": percentile(gaps, 99),
+        "frame_gap_p50_seconds": percentile(frame_gaps, 50),
+        "frame_gap_p99_seconds": percentile(frame_gaps, 99),
+        "tokens_per_frame": sum(turn.tokens for turn in completed) / sum(turn.frames for turn in completed) if completed else None,
+        "jitter_p50_seconds": percentile(jitter, 50),
+        "jitter_p99_seconds": percentile(jitter, 99),
+        "turn_latency_p50_seconds": percentile(durations, 50),
+        "turn_latency_p99_seconds": percentile(durations, 99),
+    }
+
+
+async def serve(stack: contextlib.AsyncExitStack, app) -> int:
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+
+    async def stop() -> None:
+        server.should_exit = True
+        await server_task
+
+    stack.push_async_callback(stop)
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return port
+
+
+async def start_local_stack(args: argparse.Namespace, stack: contextlib.AsyncExitStack) -> str:
+    """
+    Runs FakeOpenAI, a Temporal dev server, every worker pool and the Chainlit server with
+    app.py in this process, returns the Chainlit URL.
+    """
+    fake_openai = FakeOpenAI(FakeOpenAIConfig(
+        tokens_per_second=args.tokens_per_second,
+        tokens_per_reply=args.tokens_per_reply,
+        first_token_latency_ms=args.first_token_latency_ms,
+        api_latency_ms=args.api_latency_ms,
+        tool_call_probability=args.tool_call_probability,
+        seed=args.seed,
+    ))
+    fake_openai_port = await serve(stack, fake_openai.app())
+
+    configure_environment(f"http://127.0.0.1:{fake_openai_port}")
+    if args.fakeredis:
+        use_fakeredis()
+
+    from temporalio.testing import WorkflowEnvironment
+    from clients.payload_codec import get_data_converter
+
+    environment = await WorkflowEnvironment.start_local(data_converter=get_data_converter())
+    stack.push_async_callback(environment.shutdown)
+
+    # app.py and the worker read the Temporal address when they are imported
+    host, port = environment.client.service_client.config.target_host.rsplit(":", 1)
+    os.environ["TEMPORAL_HOST"] = host
+    os.environ["TEMPORAL_PORT"] = port
+
+    import temporal_worker
+
+    for worker in temporal_worker.create_workers(environment.client, list(temporal_worker.WORKER_POOLS)):
+        await stack.enter_async_context(worker)
+
+    from chainlit.config import config, load_module
+
+    config.run.headless = True
+    config.run.module_name = "app.py"
+    load_module(config.run.module_name)
+
+    from chainlit.server import app as chainlit_app
+
+    chainlit_port = await serve(stack, chainlit_app)
+    return f"http://127.0.0.1:{chainlit_port}"
+
+
+async def run_load(args: argparse.Namespace) -> List[dict]:
+    rng = random.Random(args.seed)
+    results = []
+
+    async with contextlib.AsyncExitStack() as stack:
+        url = await start_local_stack(args, stack) if args.local else args.url
+
+        for concurrency in [int(value) for value in args.concurrency.split(",")]:
+            started_at = time.perf_counter()
+            sessions = await asyncio.gather(*[
+                run_session(url, args, args.ramp_seconds * index / concurrency, random.Random(rng.random()))
+                for index in range(concurrency)
+            ])
+            summary = summarize(concurrency, sessions, time.perf_counter() - started_at)
+            print(json.dumps(summary), file=sys.stderr)
+            results.append(summary)
+
+    return results
+
+
+def write_curve(path: str, results: List[dict]) -> None:
+    columns = [key for key, value in results[0].items() if not isinstance(value, dict)]
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    results = asyncio.run(run_load(args))
+
+    config = {key: value for key, value in vars(args).items() if key != "token"}
+    output = json.dumps({"config": config, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.csv and results:
+        write_curve(args.csv, results)
+
+
+if __name__ == "__main__":
+    main()
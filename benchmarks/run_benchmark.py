@@ -0,0 +1,278 @@
+"""
+Offline end-to-end benchmark of the chat stack.
+
+Runs the real ConversationThreadWorkflow and activities on an in-process worker against a
+local Temporal dev server, a local redis (or fakeredis) and the FakeOpenAI stand-in, and
+drives the app.py handlers for an increasing number of concurrent sessions.
+
+    python -m benchmarks.run_benchmark --concurrency 1,10,50 --turns 3 --output results.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import uvicorn
+
+from benchmarks.fake_openai import FakeOpenAI, FakeOpenAIConfig
+
+
+PROMPTS = [
+    "What's the weather like today?",
+    "Should I take an umbrella?",
+    "Tell me something about my city.",
+    "What should I wear this evening?",
+]
+
+
+def count_tokens(text: str) -> int:
+    """
+    FakeOpenAI streams one word per token. Chainlit frames carry deltas merged by the
+    publisher and the UI coalescer, so tokens are counted in the text, not per frame.
+    """
+    return len(text.split())
+
+
+@dataclass
+class TurnResult:
+    time_to_first_token: Optional[float] = None
+    duration: float = 0.0
+    tokens: int = 0
+    frames: int = 0
+    tokens_per_second: Optional[float] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class SessionResult:
+    start_latency: float = 0.0
+    turns: List[TurnResult] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,5,10,25", help="Comma separated numbers of concurrent sessions")
+    parser.add_argument("--turns", type=int, default=3, help="User messages per session")
+    parser.add_argument("--think-time-ms", type=int, default=0, help="Pause between the turns of a session")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--tokens-per-reply", type=int, default=60)
+    parser.add_argument("--first-token-latency-ms", type=int, default=300)
+    parser.add_argument("--api-latency-ms", type=int, default=20)
+    parser.add_argument("--tool-call-probability", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--temporal-address", default=None, help="Use a running Temporal server instead of a local dev server")
+    parser.add_argument("--fakeredis", action="store_true", help="Use an in-process fakeredis instead of REDIS_HOST/REDIS_PORT")
+    parser.add_argument("--output", default=None, help="Write the JSON results to this file instead of stdout")
+    return parser.parse_args(argv)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def configure_environment(fake_openai_url: str) -> None:
+    """
+    Points every client at the local stand-ins, has to run before the app and worker modules are imported.
+    """
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["OPENAI_ASSISTANT_ID"] = "asst_benchmark"
+    os.environ["OPENAI_GATEWAY_URL"] = fake_openai_url + "/v1"
+    os.environ["WEATHER_GEOCODING_URL"] = fake_openai_url + "/geo/search"
+    os.environ["WEATHER_FORECAST_URL"] = fake_openai_url + "/weather/forecast"
+    os.environ["IP_GEOLOCATION_URL"] = fake_openai_url + "/ip/"
+    os.environ.setdefault("REDIS_HOST", "localhost")
+    os.environ.setdefault("REDIS_PORT", "6379")
+    os.environ.setdefault("TEMPORAL_HOST", "localhost")
+    os.environ.setdefault("TEMPORAL_PORT", "7233")
+
+
+def use_fakeredis() -> None:
+    import fakeredis
+    import redis.asyncio as redis
+    from fakeredis.aioredis import FakeConnection
+    from clients import redis_client
+
+    redis_client.redis_pool = redis.ConnectionPool(
+        connection_class=FakeConnection,
+        server=fakeredis.FakeServer(),
+    )
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+async def run_session(app, turns: int, think_time: float) -> SessionResult:
+    import chainlit as cl
+    from chainlit.context import ChainlitContext, context_var
+    from chainlit.emitter import BaseChainlitEmitter
+    from chainlit.session import HTTPSession
+
+    class RecordingEmitter(BaseChainlitEmitter):
+        def __init__(self, session) -> None:
+            super().__init__(session)
+            self.frames: List[Tuple[float, int]] = []
+
+        async def send_token(self, id: str, token: str, is_sequence=False):
+            self.frames.append((time.perf_counter(), count_tokens(token)))
+
+    session = HTTPSession(id=str(uuid.uuid4()), client_type="webapp", thread_id=str(uuid.uuid4()))
+    emitter = RecordingEmitter(session)
+    context_var.set(ChainlitContext(session, emitter=emitter))
+
+    result = SessionResult()
+
+    started_at = time.perf_counter()
+    try:
+        await app.start_chat()
+    except Exception as e:
+        result.error = repr(e)
+        return result
+    result.start_latency = time.perf_counter() - started_at
+
+    for turn in range(turns):
+        emitter.frames = []
+
+        turn_started_at = time.perf_counter()
+        await app.main(cl.Message(content=PROMPTS[turn % len(PROMPTS)], author="User"))
+        frames = emitter.frames
+        turn_result = TurnResult(
+            duration=time.perf_counter() - turn_started_at,
+            tokens=sum(tokens for _, tokens in frames),
+            frames=len(frames),
+        )
+
+        # app.main reports errors to the user instead of raising, an empty reply is a failed turn
+        if frames:
+            turn_result.time_to_first_token = frames[0][0] - turn_started_at
+            streaming_time = frames[-1][0] - frames[0][0]
+            if streaming_time > 0:
+                # Tokens of the first frame arrived at the start of the measured interval
+                turn_result.tokens_per_second = (turn_result.tokens - frames[0][1]) / streaming_time
+        else:
+            turn_result.error = "no tokens received"
+
+        result.turns.append(turn_result)
+
+        if think_time:
+            await asyncio.sleep(think_time)
+
+    await app.end_chat()
+
+    return result
+
+
+def summarize(concurrency: int, sessions: List[SessionResult], wall_time: float) -> dict:
+    turns = [turn for session in sessions for turn in session.turns]
+    completed = [turn for turn in turns if turn.error is None]
+    ttft = [turn.time_to_first_token for turn in completed]
+    durations = [turn.duration for turn in completed]
+    rates = [turn.tokens_per_second for turn in completed if turn.tokens_per_second]
+    start_latencies = [session.start_latency for session in sessions if session.error is None]
+
+    return {
+        "concurrency": concurrency,
+        "sessions": len(sessions),
+        "session_errors": sum(1 for session in sessions if session.error is not None),
+        "turns": len(turns),
+        "turn_errors": len(turns) - len(completed),
+        "wall_time_seconds": wall_time,
+        "sessions_per_second": len(sessions) / wall_time if wall_time else None,
+        "session_start_p50_seconds": percentile(start_latencies, 50),
+        "session_start_p99_seconds": percentile(start_latencies, 99),
+        "time_to_first_token_p50_seconds": percentile(ttft, 50),
+        "time_to_first_token_p99_seconds": percentile(ttft, 99),
+        "turn_latency_p50_seconds": percentile(durations, 50),
+        "turn_latency_p99_seconds": percentile(durations, 99),
+        "tokens_per_second_per_turn_p50": percentile(rates, 50),
+        "tokens_per_second_total": sum(turn.tokens for turn in completed) / wall_time if wall_time else None,
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> List[dict]:
+    fake_openai = FakeOpenAI(FakeOpenAIConfig(
+        tokens_per_second=args.tokens_per_second,
+        tokens_per_reply=args.tokens_per_reply,
+        first_token_latency_ms=args.first_token_latency_ms,
+        api_latency_ms=args.api_latency_ms,
+        tool_call_probability=args.tool_call_probability,
+        seed=args.seed,
+    ))
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(fake_openai.app(), host="127.0.0.1", port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    configure_environment(f"http://127.0.0.1:{port}")
+    if args.fakeredis:
+        use_fakeredis()
+
+    from temporalio.client import Client
+    from temporalio.testing import WorkflowEnvironment
+
+    from clients.payload_codec import get_data_converter
+    import app
+    import temporal_worker
+
+    environment = None
+    if args.temporal_address:
+        client = await Client.connect(args.temporal_address, data_converter=get_data_converter())
+    else:
+        environment = await WorkflowEnvironment.start_local(data_converter=get_data_converter())
+        client = environment.client
+
+    app.temporal_client = client
+
+    results = []
+    try:
+        async with contextlib.AsyncExitStack() as workers:
+            # Every pool polls its own task queue, like separate worker deployments would
+            for worker in temporal_worker.create_workers(client, list(temporal_worker.WORKER_POOLS)):
+                await workers.enter_async_context(worker)
+
+            for concurrency in [int(value) for value in args.concurrency.split(",")]:
+                started_at = time.perf_counter()
+                sessions = await asyncio.gather(*[
+                    run_session(app, args.turns, args.think_time_ms / 1000) for _ in range(concurrency)
+                ])
+                summary = summarize(concurrency, sessions, time.perf_counter() - started_at)
+                print(json.dumps(summary), file=sys.stderr)
+                results.append(summary)
+    finally:
+        if environment is not None:
+            await environment.shutdown()
+        server.should_exit = True
+        await server_task
+
+    return results
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    results = asyncio.run(run_benchmark(args))
+
+    output = json.dumps({"config": vars(args), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import asyncio
+import os
+from typing import Dict, Optional
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_PER_HOST_CONCURRENCY = int(os.getenv("HTTP_PER_HOST_CONCURRENCY", "10"))
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "10"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "3"))
+
+
+class HttpExecutor:
+    """
+    Shared asyncio HTTP client for tools and lookups made from activities.
+
+    Connections are kept alive and reused across calls, and every host gets its own
+    concurrency limit so a slow third-party API can only hold a bounded number of
+    requests while calls to other hosts keep flowing.
+    """
+    def __init__(
+        self,
+        per_host_concurrency: int = HTTP_PER_HOST_CONCURRENCY,
+        timeout_seconds: float = HTTP_TIMEOUT_SECONDS,
+    ) -> None:
+        self.per_host_concurrency = per_host_concurrency
+        self.timeout_seconds = timeout_seconds
+        self.client: Optional[httpx.AsyncClient] = None
+        self.host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    async def get_json(
+        self,
+        url: str,
+        params: Optional[dict] = None,
+        headers: Optional[dict] = None,
+        timeout_seconds: Optional[float] = None,
+    ):
+        host = httpx.URL(url).host
+        semaphore = self.host_semaphores.setdefault(host, asyncio.Semaphore(self.per_host_concurrency))
+
+        async with semaphore:
+            response = await self._get_client().get(
+                url,
+                params=params,
+                headers=headers,
+                timeout=timeout_seconds or self.timeout_seconds,
+            )
+
+        response.raise_for_status()
+        return response.json()
+
+    async def aclose(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                ),
+                timeout=httpx.Timeout(self.timeout_seconds, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+                headers={"Content-Type": "application/json"},
+            )
+        return self.client
+
+
+http_executor = HttpExecutor()
@@ -0,0 +1,86 @@
+import dataclasses
+import os
+import zlib
+from typing import Iterable, List
+from dotenv import load_dotenv
+from temporalio.api.common.v1 import Payload
+from temporalio.converter import DataConverter, PayloadCodec
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+load_dotenv()
+
+# Payloads smaller than this are stored as they are, compressing them saves next to nothing
+TEMPORAL_PAYLOAD_COMPRESSION_THRESHOLD = int(os.getenv("TEMPORAL_PAYLOAD_COMPRESSION_THRESHOLD", "1024"))
+# zstd when the zstandard package is installed, zlib otherwise
+TEMPORAL_PAYLOAD_COMPRESSION = os.getenv("TEMPORAL_PAYLOAD_COMPRESSION", "zstd" if zstandard else "zlib")
+
+ZSTD_ENCODING = b"binary/zstd"
+ZLIB_ENCODING = b"binary/zlib"
+
+
+class CompressionCodec(PayloadCodec):
+    """
+    Compresses workflow and activity payloads above a size threshold before they reach
+    Temporal, which keeps event histories and replays small.
+
+    The whole original payload, metadata included, is compressed into a new payload whose
+    encoding names the compression. Smaller payloads and payloads that do not shrink pass
+    through unchanged, so either side can read histories written by the other.
+    """
+    def __init__(
+        self,
+        threshold: int = TEMPORAL_PAYLOAD_COMPRESSION_THRESHOLD,
+        compression: str = TEMPORAL_PAYLOAD_COMPRESSION,
+    ) -> None:
+        if compression == "zstd" and zstandard is None:
+            raise RuntimeError("zstd payload compression requires the zstandard package")
+        if compression not in ("zstd", "zlib"):
+            raise ValueError(f"Unsupported payload compression {compression}")
+
+        self.threshold = threshold
+        self.compression = compression
+
+    async def encode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        return [self._encode(payload) for payload in payloads]
+
+    async def decode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        return [self._decode(payload) for payload in payloads]
+
+    def _encode(self, payload: Payload) -> Payload:
+        if payload.ByteSize() < self.threshold:
+            return payload
+
+        data = payload.SerializeToString()
+        if self.compression == "zstd":
+            encoding, compressed = ZSTD_ENCODING, zstandard.ZstdCompressor().compress(data)
+        else:
+            encoding, compressed = ZLIB_ENCODING, zlib.compress(data)
+
+        if len(compressed) >= len(data):
+            return payload
+
+        return Payload(metadata={"encoding": encoding}, data=compressed)
+
+    def _decode(self, payload: Payload) -> Payload:
+        encoding = payload.metadata.get("encoding", b"")
+        if encoding == ZSTD_ENCODING:
+            if zstandard is None:
+                raise RuntimeError("Payload is zstd compressed but the zstandard package is not installed")
+            data = zstandard.ZstdDecompressor().decompress(payload.data)
+        elif encoding == ZLIB_ENCODING:
+            data = zlib.decompress(payload.data)
+        else:
+            return payload
+
+        return Payload.FromString(data)
+
+
+def get_data_converter() -> DataConverter:
+    """
+    Data converter for every Temporal client of the app, the worker and the benchmark.
+    """
+    return dataclasses.replace(DataConverter.default, payload_codec=CompressionCodec())
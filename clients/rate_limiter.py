@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from dotenv import load_dotenv
+from clients.redis_client import get_redis_client
+from telemetry.metrics import OPENAI_RATE_LIMIT_WAIT
+
+load_dotenv()
+
+# Provider limits per minute, 0 disables the respective bucket
+OPENAI_RATE_LIMIT_RPM = int(os.getenv("OPENAI_RATE_LIMIT_RPM", "0"))
+OPENAI_RATE_LIMIT_TPM = int(os.getenv("OPENAI_RATE_LIMIT_TPM", "0"))
+# Share of the provider limits the workers use together, keeps throughput just below them
+OPENAI_RATE_LIMIT_HEADROOM = float(os.getenv("OPENAI_RATE_LIMIT_HEADROOM", "0.9"))
+# Tokens reserved for a run before its usage is known, corrected once the run completes
+OPENAI_ESTIMATED_TOKENS_PER_RUN = int(os.getenv("OPENAI_ESTIMATED_TOKENS_PER_RUN", "1500"))
+
+RATE_LIMIT_KEY = "openai:rate-limit"
+# A waiter that stops polling for this long (e.g. its worker died) loses its place in the queue
+WAITER_TTL_MS = 5000
+MAX_POLL_INTERVAL_MS = 250
+
+logger = logging.getLogger(__name__)
+
+# Two token buckets, requests and tokens, refilled continuously at their per-minute rate.
+# Callers queue in arrival order and only the head of the queue may take from the buckets,
+# so a stream of small requests cannot starve a large one. Returns 0 when the caller was
+# admitted, otherwise the milliseconds it should wait before asking again.
+ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local ticket = ARGV[1]
+local rpm = tonumber(ARGV[2])
+local tpm = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local waiter_ttl = tonumber(ARGV[5])
+
+if not redis.call('ZSCORE', KEYS[3], ticket) then
+    redis.call('ZADD', KEYS[3], redis.call('INCR', KEYS[5]), ticket)
+end
+redis.call('ZADD', KEYS[4], now + waiter_ttl, ticket)
+local expired = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', now)
+for _, expired_ticket in ipairs(expired) do
+    redis.call('ZREM', KEYS[3], expired_ticket)
+    redis.call('ZREM', KEYS[4], expired_ticket)
+end
+
+local head = redis.call('ZRANGE', KEYS[3], 0, 0)[1]
+if head ~= ticket then
+    return 25
+end
+
+local function refill(key, per_minute)
+    local bucket = redis.call('HMGET', key, 'level', 'updated')
+    local level = tonumber(bucket[1]) or per_minute
+    local updated = tonumber(bucket[2]) or now
+    level = math.min(per_minute, level + (now - updated) * per_minute / 60000)
+    return level
+end
+
+local requests = rpm > 0 and refill(KEYS[1], rpm) or 0
+local tokens = tpm > 0 and refill(KEYS[2], tpm) or 0
+cost = tpm > 0 and math.min(cost, tpm) or 0
+
+local wait = 0
+if rpm > 0 and requests < 1 then
+    wait = math.max(wait, (1 - requests) * 60000 / rpm)
+end
+if tpm > 0 and tokens < cost then
+    wait = math.max(wait, (cost - tokens) * 60000 / tpm)
+end
+if wait > 0 then
+    return math.ceil(wait)
+end
+
+if rpm > 0 then
+    redis.call('HSET', KEYS[1], 'level', requests - 1, 'updated', now)
+    redis.call('PEXPIRE', KEYS[1], 120000)
+end
+if tpm > 0 then
+    redis.call('HSET', KEYS[2], 'level', tokens - cost, 'updated', now)
+    redis.call('PEXPIRE', KEYS[2], 120000)
+end
+redis.call('ZREM', KEYS[3], ticket)
+redis.call('ZREM', KEYS[4], ticket)
+return 0
+"""
+
+# Charges (or refunds) the difference between the estimated and the actual tokens of a run
+SETTLE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local tpm = tonumber(ARGV[1])
+local delta = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'level', 'updated')
+local level = tonumber(bucket[1]) or tpm
+local updated = tonumber(bucket[2]) or now
+level = math.min(tpm, level + (now - updated) * tpm / 60000) - delta
+redis.call('HSET', KEYS[1], 'level', level, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], 120000)
+return 0
+"""
+
+
+class RateLimiter:
+    """
+    Admission control for OpenAI calls shared by all workers through redis.
+
+    Every call takes a request and, for runs, an estimate of its tokens from per-minute
+    buckets sized a bit below the provider limits, waiting in a FIFO queue when they are
+    empty. Since a conversation runs one request at a time, arrival order is fair across
+    sessions. The limiter is an optimization, calls go through when redis is unavailable.
+    """
+    def __init__(
+        self,
+        requests_per_minute: int = OPENAI_RATE_LIMIT_RPM,
+        tokens_per_minute: int = OPENAI_RATE_LIMIT_TPM,
+        headroom: float = OPENAI_RATE_LIMIT_HEADROOM,
+        key: str = RATE_LIMIT_KEY,
+    ) -> None:
+        self.requests_per_minute = int(requests_per_minute * headroom)
+        self.tokens_per_minute = int(tokens_per_minute * headroom)
+        self.key = key
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests_per_minute > 0 or self.tokens_per_minute > 0
+
+    async def acquire(self, call: str, tokens: int = 0) -> float:
+        """
+        Waits until the call may be made, returns the seconds waited.
+        """
+        if not self.enabled:
+            return 0.0
+
+        started_at = time.perf_counter()
+        ticket = str(uuid.uuid4())
+        keys = [
+            self.key + ":requests",
+            self.key + ":tokens",
+            self.key + ":queue",
+            self.key + ":waiters",
+            self.key + ":seq",
+        ]
+        redis_client = get_redis_client()
+
+        try:
+            while True:
+                wait_ms = await redis_client.eval(
+                    ACQUIRE_SCRIPT, len(keys), *keys,
+                    ticket,
+                    self.requests_per_minute, self.tokens_per_minute, tokens, WAITER_TTL_MS,
+                )
+                if int(wait_ms) <= 0:
+                    break
+
+                await asyncio.sleep(min(int(wait_ms), MAX_POLL_INTERVAL_MS) / 1000)
+        except asyncio.CancelledError:
+            await self._leave_queue(keys, ticket)
+            raise
+        except Exception:
+            logger.exception("Rate limiter failed, letting the call through")
+            await self._leave_queue(keys, ticket)
+
+        waited = time.perf_counter() - started_at
+        OPENAI_RATE_LIMIT_WAIT.labels(call).observe(waited)
+        return waited
+
+    async def settle(self, estimated_tokens: int, actual_tokens: int) -> None:
+        if self.tokens_per_minute <= 0 or actual_tokens == estimated_tokens:
+            return
+
+        try:
+            await get_redis_client().eval(
+                SETTLE_SCRIPT, 1, self.key + ":tokens",
+                self.tokens_per_minute, actual_tokens - estimated_tokens,
+            )
+        except Exception:
+            logger.exception("Failed to settle rate limiter tokens")
+
+    async def _leave_queue(self, keys, ticket: str) -> None:
+        try:
+            await get_redis_client().zrem(keys[2], ticket)
+            await get_redis_client().zrem(keys[3], ticket)
+        except Exception:
+            # The ticket expires from the queue on its own
+            logger.exception("Failed to leave the rate limiter queue")
+
+
+openai_rate_limiter = RateLimiter()
@@ -0,0 +1,29 @@
+import os
+import redis.asyncio as redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_PORT = os.getenv("REDIS_PORT")
+
+# Upper bound of open connections per process, callers wait for a free one instead of failing
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+
+redis_pool = redis.BlockingConnectionPool.from_url(
+    'redis://' + REDIS_HOST + ':' + REDIS_PORT,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    health_check_interval=10,
+    socket_connect_timeout=5,
+    retry_on_timeout=True,
+    socket_keepalive=True
+)
+
+
+def get_redis_client() -> redis.Redis:
+    """
+    Returns an asyncio redis client backed by the shared per-process connection pool.
+    """
+    return redis.Redis(connection_pool=redis_pool)
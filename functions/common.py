@@ -1,19 +1,15 @@
+from functions.registry import execute_tool, get_tool, get_tool_policy, run_tool
+# Importing the implementations registers them as tools
 from functions.function_implementations import (
-    get_weather,
     default_function,
 )
 
 
-def process_function_calls(
+async def process_function_calls(
     function_name, arguments
 ):
+    spec = get_tool(function_name)
+    if spec is None:
+        return await run_tool(default_function)
 
-    if function_name == "get_weather":
-        result = get_weather(
-            arguments.get("location"),
-            arguments.get("unit")
-        )
-    else:
-        result = default_function()
-
-    return result
+    return await execute_tool(spec, arguments)
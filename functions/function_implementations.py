@@ -1,35 +1,77 @@
 import json
-import requests
 import os
+from datetime import timedelta
 from dotenv import load_dotenv
+from temporalio.common import RetryPolicy
+from clients.http_client import http_executor
+from functions.registry import tool
 
 load_dotenv()
 
+WEATHER_CACHE_TTL_SECONDS = int(os.getenv("WEATHER_CACHE_TTL_SECONDS", "600"))
+WEATHER_GEOCODING_URL = os.getenv("WEATHER_GEOCODING_URL", "https://geocoding-api.open-meteo.com/v1/search")
+WEATHER_FORECAST_URL = os.getenv("WEATHER_FORECAST_URL", "https://api.open-meteo.com/v1/forecast")
+# Hours of the forecast passed to the assistant and the step between them
+WEATHER_FORECAST_HOURS = int(os.getenv("WEATHER_FORECAST_HOURS", "24"))
+WEATHER_FORECAST_STEP_HOURS = int(os.getenv("WEATHER_FORECAST_STEP_HOURS", "3"))
+
 
 def default_function():
     return json.dumps({"error": "Function not implemented."})
 
 
-def get_weather(location: str, unit: str):
+def project_weather(result: str) -> str:
+    """
+    Reduces the raw open-meteo forecast to its range and a few sampled hours.
+    """
+    data = json.loads(result)
+    hourly = data.get("hourly", {})
+    times = hourly.get("time", [])[:WEATHER_FORECAST_HOURS]
+    temperatures = hourly.get("temperature_2m", [])[:WEATHER_FORECAST_HOURS]
+    known = [temperature for temperature in temperatures if temperature is not None]
+
+    return json.dumps({
+        "timezone": data.get("timezone"),
+        "unit": data.get("hourly_units", {}).get("temperature_2m"),
+        "min": min(known) if known else None,
+        "max": max(known) if known else None,
+        "forecast": dict(zip(times[::WEATHER_FORECAST_STEP_HOURS], temperatures[::WEATHER_FORECAST_STEP_HOURS])),
+    })
+
+
+@tool(
+    name="get_weather",
+    parameters={
+        "type": "object",
+        "properties": {
+            "location": {"type": "string"},
+            "unit": {"type": "string", "enum": ["c", "f", "celsius", "fahrenheit"]},
+        },
+        "required": ["location"],
+    },
+    timeout=timedelta(seconds=20),
+    retry_policy=RetryPolicy(
+        initial_interval=timedelta(seconds=1),
+        backoff_coefficient=2.0,
+        maximum_attempts=3,
+    ),
+    max_concurrency=20,
+    cache_ttl_seconds=WEATHER_CACHE_TTL_SECONDS,
+    project=project_weather,
+)
+async def get_weather(location: str, unit: str = "c"):
     """Fetch the weather"""
-    try:
-        url = f"https://geocoding-api.open-meteo.com/v1/search?name={location}&count=1&language=en&format=json"
-        params = {}
-        headers = {"Content-Type": "application/json"}
-        #headers["Authorization"] = token
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-
-        url = f"https://api.open-meteo.com/v1/forecast?latitude=-{data['results'][0]['latitude']}&longitude={data['results'][0]['longitude']}&hourly=temperature_2m"
-        params = {}
-        headers = {"Content-Type": "application/json"}
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-        return json.dumps(data)
-    except requests.exceptions.HTTPError as err:
-        print(f"HTTP error occurred: {err}")
-    except Exception as err:
-        print(f"An error occurred: {err}")
-    return json.dumps({"error": "An error occurred while fetching property info."})
\ No newline at end of file
+    data = await http_executor.get_json(
+        WEATHER_GEOCODING_URL,
+        params={"name": location, "count": 1, "language": "en", "format": "json"},
+    )
+
+    data = await http_executor.get_json(
+        WEATHER_FORECAST_URL,
+        params={
+            "latitude": data['results'][0]['latitude'],
+            "longitude": data['results'][0]['longitude'],
+            "hourly": "temperature_2m",
+        },
+    )
+    return json.dumps(data)
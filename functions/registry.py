@@ -0,0 +1,145 @@
+import asyncio
+import inspect
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Callable, Dict, Optional
+import jsonschema
+from temporalio.common import RetryPolicy
+from functions.tool_cache import cached_tool
+from telemetry.metrics import TOOL_DURATION
+
+DEFAULT_TOOL_TIMEOUT = timedelta(seconds=30)
+DEFAULT_TOOL_RETRY_POLICY = RetryPolicy(
+    initial_interval=timedelta(seconds=1),
+    backoff_coefficient=2.0,
+    maximum_attempts=3,
+)
+
+
+@dataclass
+class ToolPolicy:
+    """
+    How the workflow schedules a tool call activity.
+    """
+    timeout: timedelta = DEFAULT_TOOL_TIMEOUT
+    # RetryPolicy is an unhashable dataclass, Python 3.11+ rejects it as a plain default
+    retry_policy: RetryPolicy = field(default_factory=lambda: DEFAULT_TOOL_RETRY_POLICY)
+
+
+@dataclass
+class ToolSpec:
+    name: str
+    function: Callable
+    parameters: dict
+    policy: ToolPolicy
+    max_concurrency: int
+    cache_ttl_seconds: int = 0
+    is_async: bool = False
+    project: Optional[Callable[[str], str]] = None
+    semaphore: asyncio.Semaphore = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    @property
+    def cacheable(self) -> bool:
+        return self.cache_ttl_seconds > 0
+
+
+tool_registry: Dict[str, ToolSpec] = {}
+
+
+def tool(
+    name: Optional[str] = None,
+    parameters: Optional[dict] = None,
+    timeout: timedelta = DEFAULT_TOOL_TIMEOUT,
+    retry_policy: RetryPolicy = DEFAULT_TOOL_RETRY_POLICY,
+    max_concurrency: int = 10,
+    cache_ttl_seconds: int = 0,
+    project: Optional[Callable[[str], str]] = None,
+):
+    """
+    Registers a function as an assistant tool.
+
+    `parameters` is the JSON schema of the arguments, the same one the assistant is
+    configured with. `timeout` and `retry_policy` are applied to the tool's activity,
+    `max_concurrency` caps concurrent calls per worker process and a positive
+    `cache_ttl_seconds` caches results by their normalized arguments. `project` trims a
+    raw result to what the assistant needs before it is cached, stored in the workflow
+    history and sent to the model.
+    """
+    def decorator(function):
+        tool_name = name or function.__name__
+        is_async = inspect.iscoroutinefunction(function)
+
+        implementation = function
+        if project is not None:
+            async def projected(*args, **kwargs):
+                return project(await run_tool(function, *args, **kwargs))
+            projected.__signature__ = inspect.signature(function)
+            implementation = projected
+
+        if cache_ttl_seconds > 0:
+            uncached = implementation
+
+            async def call(*args, **kwargs):
+                return await run_tool(uncached, *args, **kwargs)
+            call.__signature__ = inspect.signature(function)
+            implementation = cached_tool(tool_name, cache_ttl_seconds)(call)
+
+        tool_registry[tool_name] = ToolSpec(
+            name=tool_name,
+            function=implementation,
+            parameters=parameters or {"type": "object"},
+            policy=ToolPolicy(timeout=timeout, retry_policy=retry_policy),
+            max_concurrency=max_concurrency,
+            cache_ttl_seconds=cache_ttl_seconds,
+            is_async=is_async,
+            project=project,
+        )
+
+        return function
+
+    return decorator
+
+
+def get_tool(name: str) -> Optional[ToolSpec]:
+    return tool_registry.get(name)
+
+
+def get_tool_policy(name: str) -> ToolPolicy:
+    spec = tool_registry.get(name)
+    return spec.policy if spec else ToolPolicy()
+
+
+async def run_tool(function, *args, **kwargs):
+    """
+    Runs a tool on the event loop when it is async, legacy blocking tools are moved to a thread.
+    """
+    if inspect.iscoroutinefunction(function):
+        return await function(*args, **kwargs)
+    return await asyncio.to_thread(function, *args, **kwargs)
+
+
+async def execute_tool(spec: ToolSpec, arguments: dict) -> str:
+    try:
+        jsonschema.validate(arguments, spec.parameters)
+    except jsonschema.ValidationError as e:
+        # Returned to the assistant so it can correct its arguments, retrying would not help
+        return json.dumps({"error": f"Invalid arguments for {spec.name}: {e.message}"})
+
+    accepted = inspect.signature(spec.function).parameters
+    kwargs = {key: value for key, value in arguments.items() if key in accepted}
+
+    async with spec.semaphore:
+        started_at = time.perf_counter()
+        status = "ok"
+        try:
+            return await run_tool(spec.function, **kwargs)
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            TOOL_DURATION.labels(spec.name, status).observe(time.perf_counter() - started_at)
@@ -0,0 +1,160 @@
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, defaultdict
+from typing import Awaitable, Callable, Dict, Tuple
+from dotenv import load_dotenv
+from clients.redis_client import get_redis_client
+from telemetry.metrics import TOOL_CACHE_LOOKUPS
+
+load_dotenv()
+
+TOOL_CACHE_LOCAL_SIZE = int(os.getenv("TOOL_CACHE_LOCAL_SIZE", "1024"))
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_arguments(arguments: dict) -> str:
+    """
+    Stable cache key part for tool arguments, case and surrounding whitespace of strings are ignored.
+    """
+    normalized = {
+        key: value.strip().lower() if isinstance(value, str) else value
+        for key, value in arguments.items()
+    }
+    return json.dumps(normalized, sort_keys=True, default=str)
+
+
+class ToolResultCache:
+    """
+    Two-tier TTL cache for tool results.
+
+    An in-process LRU answers repeated lookups without a network hop and sits in front
+    of a redis tier shared by all workers. Concurrent identical lookups in a process
+    share a single call. Hits and misses are counted per tool and tier.
+    """
+    def __init__(self, local_size: int = TOOL_CACHE_LOCAL_SIZE) -> None:
+        self.local_size = local_size
+        self.local: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self.in_flight: Dict[str, asyncio.Future] = {}
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    async def get_or_call(
+        self,
+        tool_name: str,
+        ttl_seconds: int,
+        arguments: dict,
+        call: Callable[[], Awaitable[str]],
+    ) -> str:
+        digest = hashlib.sha1(normalize_arguments(arguments).encode()).hexdigest()
+        key = f"tool-cache:{tool_name}:{digest}"
+
+        result = self._get_local(key)
+        if result is not None:
+            self.counters[tool_name]["local_hits"] += 1
+            TOOL_CACHE_LOOKUPS.labels(tool_name, "local_hits").inc()
+            return result
+
+        # Someone in this process is already looking the same thing up
+        if key in self.in_flight:
+            self.counters[tool_name]["coalesced"] += 1
+            TOOL_CACHE_LOOKUPS.labels(tool_name, "coalesced").inc()
+            return await asyncio.shield(self.in_flight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            result = await self._get_shared(key)
+            if result is not None:
+                self.counters[tool_name]["redis_hits"] += 1
+                TOOL_CACHE_LOOKUPS.labels(tool_name, "redis_hits").inc()
+            else:
+                self.counters[tool_name]["misses"] += 1
+                TOOL_CACHE_LOOKUPS.labels(tool_name, "misses").inc()
+                result = await call()
+                await self._set_shared(key, result, ttl_seconds)
+
+            self._set_local(key, result, ttl_seconds)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters get the error, nobody else has to retrieve it
+            future.exception()
+            raise
+        finally:
+            self.in_flight.pop(key, None)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {tool_name: dict(counters) for tool_name, counters in self.counters.items()}
+
+    def _get_local(self, key: str):
+        entry = self.local.get(key)
+        if entry is None:
+            return None
+
+        if entry[0] < time.monotonic():
+            del self.local[key]
+            return None
+
+        self.local.move_to_end(key)
+        return entry[1]
+
+    def _set_local(self, key: str, result: str, ttl_seconds: int) -> None:
+        self.local[key] = (time.monotonic() + ttl_seconds, result)
+        self.local.move_to_end(key)
+
+        while len(self.local) > self.local_size:
+            self.local.popitem(last=False)
+
+    async def _get_shared(self, key: str):
+        try:
+            result = await get_redis_client().get(key)
+        except Exception:
+            # The shared tier is an optimization, tools keep working without redis
+            logger.exception("Failed to read tool cache")
+            return None
+
+        return result.decode() if result is not None else None
+
+    async def _set_shared(self, key: str, result: str, ttl_seconds: int) -> None:
+        try:
+            await get_redis_client().set(key, result, ex=ttl_seconds)
+        except Exception:
+            logger.exception("Failed to write tool cache")
+
+
+tool_result_cache = ToolResultCache()
+
+
+def cached_tool(tool_name: str, ttl_seconds: int):
+    """
+    Caches the string result of an async tool by its normalized arguments.
+    Exceptions are not cached.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+
+            return await tool_result_cache.get_or_call(
+                tool_name,
+                ttl_seconds,
+                dict(bound.arguments),
+                lambda: function(*args, **kwargs),
+            )
+
+        return wrapper
+
+    return decorator
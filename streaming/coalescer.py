@@ -0,0 +1,74 @@
+import asyncio
+import os
+from typing import List, Optional
+
+STREAM_UI_FLUSH_INTERVAL_MS = int(os.getenv("STREAM_UI_FLUSH_INTERVAL_MS", "50"))
+STREAM_UI_FLUSH_MAX_BYTES = int(os.getenv("STREAM_UI_FLUSH_MAX_BYTES", "1024"))
+# Above this many buffered bytes the consumer waits for the browser instead of buffering more
+STREAM_UI_MAX_PENDING_BYTES = int(os.getenv("STREAM_UI_MAX_PENDING_BYTES", "65536"))
+
+
+class TokenCoalescer:
+    """
+    Accumulates text deltas of one Chainlit message and sends them as a single
+    `stream_token` call per window instead of one websocket frame per token.
+
+    A window is flushed `flush_interval_ms` after its first delta or as soon as it holds
+    `flush_max_bytes`. Sends are serialized; while one is in progress new deltas are
+    buffered, and once `max_pending_bytes` are buffered `add` waits for the send to
+    finish, so a slow browser slows down its own session instead of growing the buffer.
+    """
+    def __init__(
+        self,
+        cl_message,
+        flush_interval_ms: int = STREAM_UI_FLUSH_INTERVAL_MS,
+        flush_max_bytes: int = STREAM_UI_FLUSH_MAX_BYTES,
+        max_pending_bytes: int = STREAM_UI_MAX_PENDING_BYTES,
+    ) -> None:
+        self.cl_message = cl_message
+        self.flush_interval: float = flush_interval_ms / 1000
+        self.flush_max_bytes: int = flush_max_bytes
+        self.max_pending_bytes: int = max_pending_bytes
+        self.buffer: List[str] = []
+        self.buffer_size: int = 0
+        self.send_lock = asyncio.Lock()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.timed_flush: Optional[asyncio.Task] = None
+
+    async def add(self, token: str) -> None:
+        self.buffer.append(token)
+        self.buffer_size += len(token)
+
+        if self.buffer_size >= self.max_pending_bytes or (
+            self.buffer_size >= self.flush_max_bytes and not self.send_lock.locked()
+        ):
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_timed_flush)
+
+    async def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        async with self.send_lock:
+            if not self.buffer:
+                return
+
+            text = "".join(self.buffer)
+            self.buffer = []
+            self.buffer_size = 0
+
+            await self.cl_message.stream_token(text)
+
+    async def close(self) -> None:
+        """
+        Sends whatever is buffered and waits for a pending timed flush.
+        """
+        await self.flush()
+        if self.timed_flush is not None:
+            await self.timed_flush
+
+    def _start_timed_flush(self) -> None:
+        self.timer = None
+        self.timed_flush = asyncio.get_running_loop().create_task(self.flush())
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import struct
+from typing import List
+
+# Wire formats this process can encode and decode, in order of preference
+SUPPORTED_WIRE_FORMATS = [
+    wire_format.strip()
+    for wire_format in os.getenv("STREAM_WIRE_FORMATS", "binary,json").split(",")
+    if wire_format.strip()
+]
+
+BINARY_MAGIC = 0xC7
+BINARY_VERSION = 1
+
+EVENT_CODES = {
+    "on_text_created": 1,
+    "on_text_delta": 2,
+    "on_text_done": 3,
+    "on_reply_done": 4,
+}
+EVENT_NAMES = {code: name for name, code in EVENT_CODES.items()}
+
+# magic, version, event code, sequence number, run id hash, publish time, value length
+FRAME_HEADER = struct.Struct(">BBBIQdI")
+
+
+def negotiate_wire_format(consumer_formats: List[str]) -> str:
+    """
+    First format the consumer accepts that this process can produce, JSON otherwise.
+    """
+    for wire_format in consumer_formats:
+        if wire_format in SUPPORTED_WIRE_FORMATS:
+            return wire_format
+    return "json"
+
+
+def hash_run_id(run_id: str) -> str:
+    return hashlib.blake2b(run_id.encode(), digest_size=8).hexdigest()
+
+
+def encode_events(events: List[dict], wire_format: str) -> List[bytes]:
+    """
+    Encodes the buffered events of one channel into redis messages.
+
+    JSON sends one message per event. The binary format packs all events into a single
+    message of fixed-header frames, the run id is reduced to a 64 bit hash since
+    consumers only compare it.
+    """
+    if wire_format != "binary":
+        return [json.dumps(event).encode() for event in events]
+
+    frames = []
+    for event in events:
+        value = event["v"].encode()
+        frames.append(FRAME_HEADER.pack(
+            BINARY_MAGIC,
+            BINARY_VERSION,
+            EVENT_CODES[event["e"]],
+            event["s"],
+            int(hash_run_id(event["r"]), 16),
+            event["t"],
+            len(value),
+        ))
+        frames.append(value)
+
+    return [b"".join(frames)]
+
+
+def decode_events(data: bytes) -> List[dict]:
+    if not data or data[0] != BINARY_MAGIC:
+        return [json.loads(data)]
+
+    events = []
+    position = 0
+    while position < len(data):
+        _, version, code, seq, run_hash, published_at, length = FRAME_HEADER.unpack_from(data, position)
+        if version != BINARY_VERSION:
+            raise ValueError(f"Unsupported stream frame version {version}")
+
+        position += FRAME_HEADER.size
+        events.append({
+            "e": EVENT_NAMES[code],
+            "v": data[position:position + length].decode(),
+            "r": format(run_hash, "016x"),
+            "s": seq,
+            "t": published_at,
+        })
+        position += length
+
+    return events
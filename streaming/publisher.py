@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from clients.redis_client import get_redis_client
+from streaming.codec import encode_events
+from streaming.transport import STREAM_MAXLEN, STREAM_TTL_SECONDS, stream_key, use_redis_streams
+
+STREAM_FLUSH_INTERVAL_MS = int(os.getenv("STREAM_FLUSH_INTERVAL_MS", "20"))
+STREAM_FLUSH_MAX_BYTES = int(os.getenv("STREAM_FLUSH_MAX_BYTES", "512"))
+
+logger = logging.getLogger(__name__)
+
+
+class TokenPublisher:
+    """
+    Buffers streamed events per channel and publishes them to Redis in pipelined batches.
+
+    `publish` never touches the network: events are appended to the channel buffer and a
+    single background flusher sends every buffered channel in one pipeline. Consecutive
+    text deltas of a channel are merged into one message. A flush happens `flush_interval_ms`
+    after data was buffered, as soon as a channel holds `flush_max_bytes`, or right away for
+    any non-delta event so created/done markers are never delayed.
+
+    Every event carries the id of the stream run `r` that produced it and its sequence
+    number `s`, a merged delta keeps the sequence number of its last token. With
+    STREAM_TRANSPORT=streams the events are appended to a capped, expiring redis stream
+    instead of being published on the channel, so consumers can resume from an offset.
+    Events are encoded in the wire format negotiated with the consumer of the channel.
+    """
+    def __init__(
+        self,
+        flush_interval_ms: int = STREAM_FLUSH_INTERVAL_MS,
+        flush_max_bytes: int = STREAM_FLUSH_MAX_BYTES,
+    ) -> None:
+        self.flush_interval: float = flush_interval_ms / 1000
+        self.flush_max_bytes: int = flush_max_bytes
+        self.buffers: Dict[str, List[dict]] = {}
+        self.buffer_sizes: Dict[str, int] = {}
+        self.wire_formats: Dict[str, str] = {}
+        self.drain_waiters: Dict[str, List[asyncio.Future]] = {}
+        self.has_data: Optional[asyncio.Event] = None
+        self.flush_now: Optional[asyncio.Event] = None
+        self.flusher: Optional[asyncio.Task] = None
+
+    def publish(
+        self,
+        channel: str,
+        event: str,
+        value: str,
+        run_id: str = "",
+        seq: int = 0,
+        wire_format: str = "json",
+    ) -> None:
+        self._ensure_flusher()
+
+        self.wire_formats[channel] = wire_format
+
+        buffer = self.buffers.setdefault(channel, [])
+        if (event == "on_text_delta" and buffer and buffer[-1]["e"] == "on_text_delta"
+                and buffer[-1]["r"] == run_id):
+            buffer[-1]["v"] += value
+            buffer[-1]["s"] = seq
+        else:
+            # "t" is when the event was handed over, used to measure publish-to-deliver lag
+            buffer.append({"e": event, "v": value, "r": run_id, "s": seq, "t": time.time()})
+
+        self.buffer_sizes[channel] = self.buffer_sizes.get(channel, 0) + len(value)
+        self.has_data.set()
+
+        if event != "on_text_delta" or self.buffer_sizes[channel] >= self.flush_max_bytes:
+            self.flush_now.set()
+
+    async def drain(self, channel: str) -> None:
+        """
+        Waits until everything published on the channel so far has reached Redis.
+        """
+        self._ensure_flusher()
+
+        future = asyncio.get_running_loop().create_future()
+        self.drain_waiters.setdefault(channel, []).append(future)
+        self.has_data.set()
+        self.flush_now.set()
+
+        await future
+
+    def _ensure_flusher(self) -> None:
+        if self.flusher is None or self.flusher.done():
+            self.has_data = asyncio.Event()
+            self.flush_now = asyncio.Event()
+            self.flusher = asyncio.get_running_loop().create_task(self._run_flusher())
+
+    async def _run_flusher(self) -> None:
+        while True:
+            await self.has_data.wait()
+
+            if not self.flush_now.is_set():
+                try:
+                    await asyncio.wait_for(self.flush_now.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            self.has_data.clear()
+            self.flush_now.clear()
+
+            await self._flush_all()
+
+    async def _flush_all(self) -> None:
+        buffers, self.buffers = self.buffers, {}
+        wire_formats, self.wire_formats = self.wire_formats, {}
+        waiters, self.drain_waiters = self.drain_waiters, {}
+        self.buffer_sizes = {}
+
+        error: Optional[Exception] = None
+        if buffers:
+            try:
+                async with get_redis_client().pipeline(transaction=False) as pipe:
+                    for channel, events in buffers.items():
+                        payloads = encode_events(events, wire_formats.get(channel, "json"))
+                        if use_redis_streams():
+                            key = stream_key(channel)
+                            for payload in payloads:
+                                pipe.xadd(key, {"d": payload}, maxlen=STREAM_MAXLEN, approximate=True)
+                            pipe.expire(key, STREAM_TTL_SECONDS)
+                        else:
+                            for payload in payloads:
+                                pipe.publish(channel, payload)
+                    await pipe.execute()
+            except Exception as e:
+                logger.exception("Failed to publish streamed events")
+                error = e
+
+        for futures in waiters.values():
+            for future in futures:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+
+
+token_publisher = TokenPublisher()
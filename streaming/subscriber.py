@@ -0,0 +1,206 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional, Union
+
+from redis.asyncio.client import PubSub
+
+from clients.redis_client import get_redis_client
+from streaming.codec import decode_events
+from streaming.transport import STREAM_READ_BLOCK_MS, STREAM_SESSION_QUEUE_SIZE, stream_key, use_redis_streams
+
+logger = logging.getLogger(__name__)
+
+# Put into the queue of a session when it is unsubscribed, its reader stops on it
+UNSUBSCRIBED = None
+
+
+class ChannelSubscriber:
+    """
+    Single long-lived pub/sub connection per process.
+
+    Sessions subscribe to their thread channel and get an `asyncio.Queue` that the
+    shared reader task fills with `(offset, events)` tuples, so the number of redis
+    connections stays constant no matter how many chats are streaming. Pub/sub has no
+    offsets, so `offset` is always None. Unsubscribing puts `UNSUBSCRIBED` into the queue.
+
+    Pub/sub cannot be paused, so once a session has `max_queue_size` messages queued
+    its text deltas are dropped and only created/done events are queued; the done
+    event carries the full text, so a slow session still ends with the whole reply.
+    """
+    def __init__(self, max_queue_size: int = STREAM_SESSION_QUEUE_SIZE) -> None:
+        self.max_queue_size = max_queue_size
+        self.pubsub: Optional[PubSub] = None
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.has_channels: Optional[asyncio.Event] = None
+        self.reader: Optional[asyncio.Task] = None
+
+    async def subscribe(self, channel: str, offset: Optional[str] = None) -> asyncio.Queue:
+        self._ensure_reader()
+
+        # Register the queue before subscribing so no message can arrive unrouted
+        queue = asyncio.Queue()
+        self.queues[channel] = queue
+
+        await self.pubsub.subscribe(channel)
+        self.has_channels.set()
+
+        return queue
+
+    async def unsubscribe(self, channel: str) -> None:
+        queue = self.queues.pop(channel, None)
+        if queue is None:
+            return
+
+        queue.put_nowait(UNSUBSCRIBED)
+
+        if not self.queues:
+            self.has_channels.clear()
+
+        await self.pubsub.unsubscribe(channel)
+
+    def _ensure_reader(self) -> None:
+        if self.reader is None or self.reader.done():
+            self.pubsub = get_redis_client().pubsub()
+            self.has_channels = asyncio.Event()
+            self.reader = asyncio.get_running_loop().create_task(self._run_reader())
+
+    async def _run_reader(self) -> None:
+        while True:
+            await self.has_channels.wait()
+
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception:
+                # The pub/sub connection re-subscribes its channels when it reconnects
+                logger.exception("Redis subscriber failed to read a message")
+                await asyncio.sleep(1)
+                continue
+
+            if message is None:
+                continue
+
+            queue = self.queues.get(message["channel"].decode())
+            if queue is None:
+                continue
+
+            events = decode_events(message["data"])
+            if queue.qsize() >= self.max_queue_size:
+                events = [event for event in events if event["e"] != "on_text_delta"]
+
+            if events:
+                queue.put_nowait((None, events))
+
+
+class StreamSubscriber:
+    """
+    Single reader task per process that tails the redis streams of all subscribed threads
+    with one blocking XREAD and routes `(entry_id, events)` tuples to per-session queues.
+
+    Each thread is read from the offset it was subscribed with, so a late subscriber or
+    a reconnecting session gets every entry after the last one it delivered. A session
+    with `max_queue_size` entries queued is left out of the reads until it catches up,
+    its entries wait in the stream meanwhile. Unsubscribing puts `UNSUBSCRIBED` into the queue.
+    """
+    def __init__(self, max_queue_size: int = STREAM_SESSION_QUEUE_SIZE) -> None:
+        self.max_queue_size = max_queue_size
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.offsets: Dict[str, str] = {}
+        self.has_channels: Optional[asyncio.Event] = None
+        self.reader: Optional[asyncio.Task] = None
+
+    async def subscribe(self, channel: str, offset: Optional[str] = None) -> asyncio.Queue:
+        self._ensure_reader()
+
+        if offset is None:
+            # Resolve "from now on" to a concrete id, "$" would skip entries between two reads
+            latest = await get_redis_client().xrevrange(stream_key(channel), count=1)
+            offset = latest[0][0].decode() if latest else "0-0"
+
+        queue = asyncio.Queue()
+        self.queues[channel] = queue
+        self.offsets[channel] = offset
+        self.has_channels.set()
+
+        return queue
+
+    async def unsubscribe(self, channel: str) -> None:
+        queue = self.queues.pop(channel, None)
+        if queue is None:
+            return
+
+        queue.put_nowait(UNSUBSCRIBED)
+        self.offsets.pop(channel, None)
+
+        if not self.queues:
+            self.has_channels.clear()
+
+    def _ensure_reader(self) -> None:
+        if self.reader is None or self.reader.done():
+            self.has_channels = asyncio.Event()
+            self.reader = asyncio.get_running_loop().create_task(self._run_reader())
+
+    async def _run_reader(self) -> None:
+        client = get_redis_client()
+
+        while True:
+            await self.has_channels.wait()
+
+            # Channels subscribed while XREAD blocks are picked up on the next call,
+            # their entries are kept in the stream so nothing is missed meanwhile
+            streams = {
+                stream_key(channel): offset
+                for channel, offset in self.offsets.items()
+                if self.queues[channel].qsize() < self.max_queue_size
+            }
+            if not streams:
+                await asyncio.sleep(STREAM_READ_BLOCK_MS / 1000)
+                continue
+
+            try:
+                response = await client.xread(streams=streams, count=100, block=STREAM_READ_BLOCK_MS)
+            except Exception:
+                logger.exception("Redis stream reader failed to read entries")
+                await asyncio.sleep(1)
+                continue
+
+            for key, entries in response or []:
+                channel = key.decode()[len(stream_key("")):]
+                queue = self.queues.get(channel)
+                if queue is None:
+                    continue
+
+                for entry_id, fields in entries:
+                    entry_id = entry_id.decode()
+                    self.offsets[channel] = entry_id
+                    queue.put_nowait((entry_id, decode_events(fields[b"d"])))
+
+
+@dataclass
+class StreamCursor:
+    """
+    Last entry delivered to a session, used to resume a stream and drop duplicates.
+    """
+    offset: Optional[str] = None
+    run_id: str = ""
+    seq: int = 0
+
+    def accept(self, offset: Optional[str], event: dict) -> bool:
+        if offset is not None:
+            self.offset = offset
+
+        if event.get("r", "") == self.run_id and event.get("s", 0) <= self.seq:
+            return False
+
+        self.run_id = event.get("r", "")
+        self.seq = event.get("s", 0)
+        return True
+
+
+def create_subscriber() -> Union[ChannelSubscriber, StreamSubscriber]:
+    if use_redis_streams():
+        return StreamSubscriber()
+    return ChannelSubscriber()
+
+
+reply_subscriber = create_subscriber()
@@ -0,0 +1,19 @@
+import os
+
+# "pubsub" publishes fire-and-forget messages on the thread channel,
+# "streams" appends them to a capped redis stream that consumers can replay from an offset
+STREAM_TRANSPORT = os.getenv("STREAM_TRANSPORT", "pubsub")
+
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", "1000"))
+STREAM_TTL_SECONDS = int(os.getenv("STREAM_TTL_SECONDS", "3600"))
+STREAM_READ_BLOCK_MS = int(os.getenv("STREAM_READ_BLOCK_MS", "100"))
+# Undelivered redis messages a session may queue before backpressure kicks in
+STREAM_SESSION_QUEUE_SIZE = int(os.getenv("STREAM_SESSION_QUEUE_SIZE", "256"))
+
+
+def use_redis_streams() -> bool:
+    return STREAM_TRANSPORT == "streams"
+
+
+def stream_key(thread_id: str) -> str:
+    return "stream:" + thread_id
@@ -0,0 +1,73 @@
+import time
+from typing import Any, Awaitable
+
+from temporalio import activity, client, worker
+
+from telemetry.metrics import ACTIVITY_DURATION, TEMPORAL_CLIENT_CALL_DURATION
+from telemetry.tracing import tracing_enabled
+
+
+async def observe_call(call: str, awaitable: Awaitable) -> Any:
+    started_at = time.perf_counter()
+    status = "ok"
+    try:
+        return await awaitable
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        TEMPORAL_CLIENT_CALL_DURATION.labels(call, status).observe(time.perf_counter() - started_at)
+
+
+class MetricsInterceptor(client.Interceptor, worker.Interceptor):
+    """
+    Records the duration of Temporal client calls and activity executions.
+
+    Registered on the client, workers created from that client pick it up as well.
+    """
+    def intercept_client(self, next: client.OutboundInterceptor) -> client.OutboundInterceptor:
+        return _ClientMetricsInterceptor(next)
+
+    def intercept_activity(self, next: worker.ActivityInboundInterceptor) -> worker.ActivityInboundInterceptor:
+        return _ActivityMetricsInterceptor(next)
+
+
+class _ClientMetricsInterceptor(client.OutboundInterceptor):
+    async def start_workflow(self, input: client.StartWorkflowInput):
+        return await observe_call("start_workflow", super().start_workflow(input))
+
+    async def signal_workflow(self, input: client.SignalWorkflowInput) -> None:
+        return await observe_call("signal_workflow", super().signal_workflow(input))
+
+    async def query_workflow(self, input: client.QueryWorkflowInput):
+        return await observe_call("query_workflow", super().query_workflow(input))
+
+    async def start_workflow_update(self, input: client.StartWorkflowUpdateInput):
+        return await observe_call("start_workflow_update", super().start_workflow_update(input))
+
+
+class _ActivityMetricsInterceptor(worker.ActivityInboundInterceptor):
+    async def execute_activity(self, input: worker.ExecuteActivityInput) -> Any:
+        started_at = time.perf_counter()
+        status = "ok"
+        try:
+            return await super().execute_activity(input)
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            ACTIVITY_DURATION.labels(activity.info().activity_type, status).observe(time.perf_counter() - started_at)
+
+
+def get_interceptors() -> list:
+    """
+    Interceptors for every Temporal client of the app and the worker.
+    """
+    interceptors = [MetricsInterceptor()]
+
+    if tracing_enabled():
+        # Propagates the span context through workflow and activity headers
+        from temporalio.contrib.opentelemetry import TracingInterceptor
+        interceptors.append(TracingInterceptor())
+
+    return interceptors
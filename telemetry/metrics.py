@@ -0,0 +1,81 @@
+import os
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Port of the /metrics endpoint of this process, 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_GAP_BUCKETS = (0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+ACTIVITY_DURATION = Histogram(
+    "chat_activity_duration_seconds",
+    "Duration of Temporal activity executions",
+    ["activity", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+TEMPORAL_CLIENT_CALL_DURATION = Histogram(
+    "chat_temporal_client_call_duration_seconds",
+    "Duration of Temporal client calls (start, signal, update, query)",
+    ["call", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "chat_time_to_first_token_seconds",
+    "Time from the start of a run (worker) or of a user message (app) to its first token",
+    ["source"],
+    buckets=LATENCY_BUCKETS,
+)
+INTER_TOKEN_GAP = Histogram(
+    "chat_inter_token_gap_seconds",
+    "Time between two consecutive text deltas of a run",
+    buckets=TOKEN_GAP_BUCKETS,
+)
+PUBLISH_TO_DELIVER = Histogram(
+    "chat_publish_to_deliver_seconds",
+    "Time from a streamed event being published by the worker to it being received by the app",
+    ["event"],
+    buckets=LATENCY_BUCKETS,
+)
+TOOL_DURATION = Histogram(
+    "chat_tool_duration_seconds",
+    "Duration of tool executions",
+    ["tool", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+IN_FLIGHT_SESSIONS = Gauge(
+    "chat_in_flight_sessions",
+    "Chat sessions currently open on this app process",
+)
+IN_FLIGHT_REPLIES = Gauge(
+    "chat_in_flight_replies",
+    "Replies currently being streamed to users by this app process",
+)
+OPENAI_RATE_LIMIT_WAIT = Histogram(
+    "chat_openai_rate_limit_wait_seconds",
+    "Time OpenAI calls waited for admission by the shared rate limiter",
+    ["call"],
+    buckets=LATENCY_BUCKETS,
+)
+SESSIONS_CLOSED = Counter(
+    "chat_sessions_closed_total",
+    "Conversations closed, reason idle counts sessions reclaimed by the idle timeout",
+    ["reason"],
+)
+RESPONSE_CACHE_LOOKUPS = Counter(
+    "chat_response_cache_lookups_total",
+    "Response cache lookups by result",
+    ["result"],
+)
+TOOL_CACHE_LOOKUPS = Counter(
+    "chat_tool_cache_lookups_total",
+    "Tool cache lookups by result",
+    ["tool", "result"],
+)
+
+
+def start_metrics_server(port_offset: int = 0) -> None:
+    """
+    Worker processes started together pass their index so each gets its own port.
+    """
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT + port_offset)
@@ -0,0 +1,26 @@
+import contextlib
+import os
+
+# Spans are only recorded when OpenTelemetry is installed and enabled,
+# the exporter itself is configured through the standard OTEL_* variables
+OTEL_ENABLED = os.getenv("OTEL_ENABLED", "false").lower() == "true"
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+
+def tracing_enabled() -> bool:
+    return OTEL_ENABLED and trace is not None
+
+
+def start_span(name: str, workflow_id: str = "", **attributes):
+    """
+    Starts a span tagged with the workflow id, or does nothing when tracing is disabled.
+    """
+    if not tracing_enabled():
+        return contextlib.nullcontext()
+
+    attributes["temporal.workflow_id"] = workflow_id
+    return trace.get_tracer("temporal-chainlit").start_as_current_span(name, attributes=attributes)
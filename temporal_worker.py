@@ -1,14 +1,25 @@
+import argparse
 import asyncio
-import concurrent.futures
 import logging
+import multiprocessing
 import os
+from datetime import timedelta
+from typing import List
 
 from temporalio.client import Client
+from temporalio.exceptions import WorkflowAlreadyStartedError
 from temporalio.worker import Worker
 
 from workflows.conversation_thread_workflow import ConversationThreadWorkflow
+from workflows.thread_pool_workflow import THREAD_POOL_WORKFLOW_ID, ThreadPoolParams, ThreadPoolRefillWorkflow
 
 from activities.conversation_thread_activities import ConversationThreadActivities
+from clients.payload_codec import get_data_converter
+from telemetry.interceptors import get_interceptors
+from telemetry.metrics import start_metrics_server
+from workers.pools import WORKER_POOLS, WORKFLOW_TASK_QUEUE, WorkerPool
+
+from activities.thread_pool_activities import THREAD_POOL_REFILL_INTERVAL_SECONDS, THREAD_POOL_SIZE, ThreadPoolActivities
 
 
 openai_api_key = os.getenv("OPENAI_API_KEY")
@@ -21,37 +32,144 @@ TEMPORAL_PORT = os.getenv("TEMPORAL_PORT")
 temporal_connection_string = TEMPORAL_HOST + ":" + TEMPORAL_PORT
 print(temporal_connection_string)
 
-async def main():
+async def start_thread_pool_refill(client: Client):
+    if THREAD_POOL_SIZE <= 0:
+        return
+
+    try:
+        await client.start_workflow(
+            ThreadPoolRefillWorkflow.run,
+            ThreadPoolParams(
+                target_size=THREAD_POOL_SIZE,
+                refill_interval_seconds=THREAD_POOL_REFILL_INTERVAL_SECONDS,
+            ),
+            id=THREAD_POOL_WORKFLOW_ID,
+            task_queue=WORKFLOW_TASK_QUEUE,
+        )
+    except WorkflowAlreadyStartedError:
+        # Another worker already keeps the pool filled
+        pass
+
+def create_worker(client: Client, pool: WorkerPool) -> Worker:
+    """
+    Worker for one pool. All activities are async, so no activity executor is needed.
+    """
+    conversation_thread_activities = ConversationThreadActivities(openai_api_key, openai_gateway_url, openai_assistant_id)
+    thread_pool_activities = ThreadPoolActivities(openai_api_key, openai_gateway_url)
+
+    workflows = []
+    if pool.name == "workflow":
+        workflows = [ConversationThreadWorkflow, ThreadPoolRefillWorkflow]
+        activities = [
+            conversation_thread_activities.create_thread,
+            conversation_thread_activities.add_message_to_thread,
+            conversation_thread_activities.cancel_run,
+            conversation_thread_activities.end_reply,
+            conversation_thread_activities.close_thread,
+            thread_pool_activities.claim_thread,
+            thread_pool_activities.refill_thread_pool,
+        ]
+    elif pool.name == "llm":
+        activities = [
+            conversation_thread_activities.get_response,
+            conversation_thread_activities.submit_tool_call_result,
+        ]
+    elif pool.name == "tools":
+        activities = [
+            conversation_thread_activities.function_call,
+            conversation_thread_activities.get_city,
+        ]
+    else:
+        raise ValueError(f"Unknown worker pool {pool.name}")
+
+    return Worker(
+        client,
+        task_queue=pool.task_queue,
+        workflows=workflows,
+        activities=activities,
+        max_concurrent_activities=pool.max_concurrent_activities,
+        max_concurrent_workflow_tasks=pool.max_concurrent_workflow_tasks,
+        max_cached_workflows=pool.max_cached_workflows,
+        # Cancelled streaming runs must notice within about a second
+        max_heartbeat_throttle_interval=timedelta(seconds=1),
+    )
+
+def create_workers(client: Client, pool_names: List[str]) -> List[Worker]:
+    return [create_worker(client, WORKER_POOLS[pool_name]) for pool_name in pool_names]
+
+async def main(pool_names: List[str]):
     while(True):
         try:
-            client = await Client.connect(temporal_connection_string)
-
-            conversation_thread_activities = ConversationThreadActivities(openai_api_key, openai_gateway_url, openai_assistant_id)
-
-            with concurrent.futures.ThreadPoolExecutor(max_workers=100) as activity_executor:
-                worker = Worker(
-                    client,
-                    task_queue="conversation-workflow-task-queue",
-                    workflows=[ConversationThreadWorkflow],
-                    activities=[
-                        conversation_thread_activities.create_thread,
-                        conversation_thread_activities.add_message_to_thread,
-                        conversation_thread_activities.get_response,
-                        conversation_thread_activities.function_call,
-                        conversation_thread_activities.get_city,
-                        conversation_thread_activities.submit_tool_call_result,
-                    ],
-                    activity_executor=activity_executor,
-                )
-                await worker.run()
+            client = await Client.connect(
+                temporal_connection_string,
+                interceptors=get_interceptors(),
+                data_converter=get_data_converter(),
+            )
+
+            if "workflow" in pool_names:
+                await start_thread_pool_refill(client)
+
+            workers = create_workers(client, pool_names)
+            runs = [asyncio.create_task(worker.run()) for worker in workers]
+            try:
+                await asyncio.gather(*runs)
+            finally:
+                # The pools that are still running stop too, the retry starts a complete new set
+                await asyncio.gather(*[worker.shutdown() for worker in workers], return_exceptions=True)
+                await asyncio.gather(*runs, return_exceptions=True)
         except RuntimeError as e:
             print(e)
             await asyncio.sleep(5)
 
+def run_process(pool_names: List[str], index: int):
+    logging.basicConfig(level=logging.INFO)
 
-if __name__ == "__main__":
-    print("Starting worker")
+    print(f"Starting worker {index} for pools {', '.join(pool_names)}")
 
-    logging.basicConfig(level=logging.INFO)
+    start_metrics_server(port_offset=index)
+
+    asyncio.run(main(pool_names))
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Runs the Temporal workers of one or all worker pools.")
+    parser.add_argument("--pool", choices=["all", *WORKER_POOLS], default=os.getenv("WORKER_POOL", "all"))
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes per pool, defaults to <POOL>_POOL_PROCESSES")
+    return parser.parse_args(argv)
+
+def launch(argv=None):
+    """
+    Starts one process per configured worker of the selected pools. When every selected
+    pool has a single worker they all run in this process, as the worker did before pools
+    were split.
+    """
+    args = parse_args(argv)
+    pool_names = list(WORKER_POOLS) if args.pool == "all" else [args.pool]
+
+    process_counts = {
+        pool_name: args.processes if args.processes is not None else WORKER_POOLS[pool_name].processes
+        for pool_name in pool_names
+    }
 
-    asyncio.run(main())
\ No newline at end of file
+    if all(count <= 1 for count in process_counts.values()):
+        run_process(pool_names, 0)
+        return
+
+    process_pools = []
+    for pool_name, count in process_counts.items():
+        process_pools.extend([[pool_name]] * max(count, 1))
+
+    # The Temporal core runtime does not survive a fork
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_process, args=(names, index), name=f"worker-{names[0]}-{index}")
+        for index, names in enumerate(process_pools)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    launch()
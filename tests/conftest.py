@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Modules are imported from the repository root, as the app and the worker run them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The redis pool is created at import time, tests replace the client with fakeredis
+os.environ.setdefault("REDIS_HOST", "localhost")
+os.environ.setdefault("REDIS_PORT", "6379")
@@ -0,0 +1,54 @@
+import struct
+
+import pytest
+
+from streaming.codec import BINARY_MAGIC, FRAME_HEADER, decode_events, encode_events, hash_run_id
+
+
+def make_event(event: str, value: str, seq: int) -> dict:
+    return {"e": event, "v": value, "r": "run-1", "s": seq, "t": 1700000000.25}
+
+
+def test_binary_round_trip_packs_events_into_one_message():
+    events = [
+        make_event("on_text_created", "", 1),
+        make_event("on_text_delta", "Grüße aus Köln ☀️ 東京", 2),
+        make_event("on_text_done", "Grüße aus Köln ☀️ 東京", 3),
+        make_event("on_reply_done", '{"message_ids": ["a"], "failed": false}', 4),
+    ]
+
+    messages = encode_events(events, "binary")
+
+    assert len(messages) == 1
+    assert messages[0][0] == BINARY_MAGIC
+    decoded = decode_events(messages[0])
+    assert [event["e"] for event in decoded] == ["on_text_created", "on_text_delta", "on_text_done", "on_reply_done"]
+    assert [event["v"] for event in decoded] == [event["v"] for event in events]
+    assert [event["s"] for event in decoded] == [1, 2, 3, 4]
+    assert all(event["t"] == 1700000000.25 for event in decoded)
+    # Consumers only compare run ids, they get the hash
+    assert all(event["r"] == hash_run_id("run-1") for event in decoded)
+
+
+def test_json_round_trip_keeps_one_message_per_event():
+    events = [make_event("on_text_delta", "naïve café", 1), make_event("on_text_delta", " – ok", 2)]
+
+    messages = encode_events(events, "json")
+
+    assert len(messages) == 2
+    assert [decode_events(message)[0] for message in messages] == events
+
+
+def test_unknown_frame_version_is_rejected():
+    value = "hi".encode()
+    frame = FRAME_HEADER.pack(BINARY_MAGIC, 2, 2, 1, 0, 0.0, len(value)) + value
+
+    with pytest.raises(ValueError, match="version 2"):
+        decode_events(frame)
+
+
+def test_truncated_frame_is_rejected():
+    message = encode_events([make_event("on_text_delta", "hello", 1)], "binary")[0]
+
+    with pytest.raises(struct.error):
+        decode_events(message[:FRAME_HEADER.size - 1])
@@ -0,0 +1,108 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from clients import rate_limiter
+from clients.rate_limiter import ACQUIRE_SCRIPT, WAITER_TTL_MS, RateLimiter
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(rate_limiter, "get_redis_client", lambda: client)
+    return client
+
+
+def keys(limiter: RateLimiter) -> list:
+    return [limiter.key + suffix for suffix in (":requests", ":tokens", ":queue", ":waiters", ":seq")]
+
+
+async def try_acquire(client, limiter: RateLimiter, ticket: str, tokens: int = 0) -> int:
+    """
+    One pass of the acquire script, 0 when admitted, otherwise the suggested wait in ms.
+    """
+    return int(await client.eval(
+        ACQUIRE_SCRIPT, 5, *keys(limiter),
+        ticket, limiter.requests_per_minute, limiter.tokens_per_minute, tokens, WAITER_TTL_MS,
+    ))
+
+
+def test_full_buckets_admit_without_waiting(redis_client):
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000, headroom=1.0, key="test")
+
+    waited = asyncio.run(limiter.acquire("run", tokens=1000))
+
+    assert waited < 0.1
+
+
+def test_empty_request_bucket_returns_refill_wait(redis_client):
+    limiter = RateLimiter(requests_per_minute=1, tokens_per_minute=0, headroom=1.0, key="test")
+
+    async def run():
+        await limiter.acquire("run")
+        return await try_acquire(redis_client, limiter, "second")
+
+    wait_ms = asyncio.run(run())
+
+    # One request per minute, the bucket is refilled a minute after it was emptied
+    assert 59000 <= wait_ms <= 60000
+
+
+def test_token_bucket_waits_for_the_missing_tokens(redis_client):
+    limiter = RateLimiter(requests_per_minute=0, tokens_per_minute=6000, headroom=1.0, key="test")
+
+    async def run():
+        assert await try_acquire(redis_client, limiter, "first", tokens=5000) == 0
+        return await try_acquire(redis_client, limiter, "second", tokens=4000)
+
+    wait_ms = asyncio.run(run())
+
+    # 3000 tokens are missing at 100 tokens per second
+    assert 29000 <= wait_ms <= 30000
+
+
+def test_callers_are_admitted_in_arrival_order(redis_client):
+    limiter = RateLimiter(requests_per_minute=0, tokens_per_minute=6000, headroom=1.0, key="test")
+
+    async def run():
+        assert await try_acquire(redis_client, limiter, "first", tokens=6000) == 0
+        # The head of the queue waits for tokens
+        head_wait = await try_acquire(redis_client, limiter, "large", tokens=3000)
+        # A later, smaller call fits the bucket refill just as well but may not overtake
+        behind_wait = await try_acquire(redis_client, limiter, "small", tokens=1)
+        queue = await redis_client.zrange(limiter.key + ":queue", 0, -1)
+        return head_wait, behind_wait, queue
+
+    head_wait, behind_wait, queue = asyncio.run(run())
+
+    assert head_wait > 1000
+    assert behind_wait == 25
+    assert queue == [b"large", b"small"]
+
+
+def test_settle_refunds_unused_tokens(redis_client):
+    limiter = RateLimiter(requests_per_minute=0, tokens_per_minute=6000, headroom=1.0, key="test")
+
+    async def run():
+        await limiter.acquire("run", tokens=5000)
+        await limiter.settle(estimated_tokens=5000, actual_tokens=1000)
+        return float(await redis_client.hget(limiter.key + ":tokens", "level"))
+
+    level = asyncio.run(run())
+
+    # 1000 left after the reservation, 4000 refunded, plus at most a moment of refill
+    assert 5000 <= level < 5100
+
+
+def test_settle_charges_tokens_above_the_estimate(redis_client):
+    limiter = RateLimiter(requests_per_minute=0, tokens_per_minute=6000, headroom=1.0, key="test")
+
+    async def run():
+        await limiter.acquire("run", tokens=1000)
+        await limiter.settle(estimated_tokens=1000, actual_tokens=3000)
+        return float(await redis_client.hget(limiter.key + ":tokens", "level"))
+
+    level = asyncio.run(run())
+
+    assert 3000 <= level < 3100
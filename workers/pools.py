@@ -0,0 +1,49 @@
+import os
+from dataclasses import dataclass
+from typing import Dict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Workflow tasks and short OpenAI calls (threads, messages, thread pool)
+WORKFLOW_TASK_QUEUE = os.getenv("WORKFLOW_TASK_QUEUE", "conversation-workflow-task-queue")
+# Long running runs that stream the assistant reply
+LLM_TASK_QUEUE = os.getenv("LLM_TASK_QUEUE", "conversation-llm-task-queue")
+# Tool calls and context lookups
+TOOLS_TASK_QUEUE = os.getenv("TOOLS_TASK_QUEUE", "conversation-tools-task-queue")
+
+
+@dataclass
+class WorkerPool:
+    """
+    Settings of the workers polling one task queue, every worker process applies them on its own.
+    """
+    name: str
+    task_queue: str
+    max_concurrent_activities: int
+    max_concurrent_workflow_tasks: int = 100
+    max_cached_workflows: int = 1000
+    processes: int = 1
+
+
+def load_pool(name: str, task_queue: str, max_concurrent_activities: int, max_cached_workflows: int = 1000) -> WorkerPool:
+    """
+    Reads the `<NAME>_POOL_*` variables, e.g. `LLM_POOL_MAX_CONCURRENT_ACTIVITIES`.
+    """
+    prefix = f"{name.upper()}_POOL_"
+    return WorkerPool(
+        name=name,
+        task_queue=task_queue,
+        max_concurrent_activities=int(os.getenv(prefix + "MAX_CONCURRENT_ACTIVITIES", str(max_concurrent_activities))),
+        max_concurrent_workflow_tasks=int(os.getenv(prefix + "MAX_CONCURRENT_WORKFLOW_TASKS", "100")),
+        max_cached_workflows=int(os.getenv(prefix + "MAX_CACHED_WORKFLOWS", str(max_cached_workflows))),
+        processes=int(os.getenv(prefix + "PROCESSES", "1")),
+    )
+
+
+WORKER_POOLS: Dict[str, WorkerPool] = {
+    "workflow": load_pool("workflow", WORKFLOW_TASK_QUEUE, max_concurrent_activities=100),
+    # Streaming runs hold a slot for the whole reply but mostly wait on the network
+    "llm": load_pool("llm", LLM_TASK_QUEUE, max_concurrent_activities=200, max_cached_workflows=0),
+    "tools": load_pool("tools", TOOLS_TASK_QUEUE, max_concurrent_activities=100, max_cached_workflows=0),
+}
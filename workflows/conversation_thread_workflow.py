@@ -1,34 +1,102 @@
 import asyncio
-from collections import deque
-from dataclasses import dataclass
+import json
+from dataclasses import dataclass, field
 from datetime import timedelta
-from typing import Deque, List, Optional, Tuple
+from typing import List, Optional, Tuple
 
 from temporalio import workflow
 from temporalio.common import RetryPolicy
+from temporalio.exceptions import ActivityError, CancelledError
+from temporalio.workflow import ActivityCancellationType, ActivityHandle
 
 with workflow.unsafe.imports_passed_through():
     from openai import AsyncAssistantEventHandler, AsyncOpenAI, OpenAI
-    from activities.conversation_thread_activities import ConversationThreadActivities, ConversationThreadMessage, ToolCallRequest, ToolCallResult, SubmitToolOutputsRequest
+    from activities.conversation_thread_activities import CancelRunRequest, CloseThreadRequest, EndReplyRequest, ConversationThreadActivities, ConversationThreadMessage, ConversationThreadMessageResponse, ConversationThreadRunRequest, ToolCallRequest, ToolCallResult, SubmitToolOutputsRequest
+    from activities.thread_pool_activities import ThreadPoolActivities
+    from functions.common import get_tool_policy
+    from streaming.codec import negotiate_wire_format
+    from workers.pools import LLM_TASK_QUEUE, TOOLS_TASK_QUEUE
 
 
-@dataclass
-class ConversationThreadParams:
-    remote_ip_address: str
+# Streaming activities that stop heartbeating for this long are retried, cancellation
+# requests are delivered with heartbeats
+STREAM_HEARTBEAT_TIMEOUT = timedelta(seconds=5)
+
+# Thread and message calls may queue in the OpenAI rate limiter for a while. They heartbeat
+# while queued, so the heartbeat timeout still bounds the call itself to a few seconds, and
+# all attempts together end after RATE_LIMITED_CALL_TIMEOUT
+RATE_LIMITED_CALL_TIMEOUT = timedelta(minutes=2)
+# Lets permanent errors, e.g. a deleted thread, fail the call instead of retrying it forever
+ADD_MESSAGE_RETRY_POLICY = RetryPolicy(
+    initial_interval=timedelta(seconds=1),
+    backoff_coefficient=2.0,
+    maximum_attempts=3,
+)
+
 
 @dataclass
 class ConversationMessage:
     author: str = ""
     message: str = ""
 
+@dataclass
+class HistoryPageRequest:
+    # Position in the whole conversation, messages compacted away by continue-as-new are skipped
+    offset: int = 0
+    limit: int = 50
+
+@dataclass
+class HistoryPage:
+    messages: list[ConversationMessage] = field(default_factory=list)
+    offset: int = 0
+    next_offset: int = 0
+    total: int = 0
+
+@dataclass
+class ConversationInput:
+    message: str
+    # Chosen by the app, lets it tell which reply answers its message
+    message_id: str = ""
+
+@dataclass
+class ConversationThreadParams:
+    remote_ip_address: str
+    # Stream wire formats the app can decode, in order of preference
+    wire_formats: list[str] = field(default_factory=lambda: ["json"])
+    # Continue as new once the event history is this long, or earlier if the server suggests it
+    max_history_length: int = 2000
+    # Number of latest messages carried over to the next run
+    history_tail_size: int = 20
+    # Closes the conversation after this long without messages, 0 keeps it open until ended
+    idle_timeout_seconds: int = 1800
+    # Delete the OpenAI thread when the conversation closes
+    delete_thread_on_close: bool = False
+    # Messages arriving this soon after the first one of a burst are answered by the same run
+    coalesce_window_ms: int = 200
+    # Claim a pre-created thread first, only worth a round trip when the pool is filled
+    use_thread_pool: bool = False
+    # Set when the workflow continues as new, the thread and its context already exist
+    thread_id: str = ""
+    remote_city: str = ""
+    history: list[ConversationMessage] = field(default_factory=list)
+    # Messages of earlier runs that were not carried over
+    history_offset: int = 0
+
 @workflow.defn
 class ConversationThreadWorkflow:
     def __init__(self) -> None:
         self.thread_closed: bool = False
+        self.close_reason: str = "ended"
         self.thread_id: str = ""
+        self.ready: bool = False
         self.params = None
         self.remote_city: str = ""
+        self.wire_format: str = "json"
         self.messages: list[ConversationMessage] = list()
+        self.history_offset: int = 0
+        self.pending_inputs: list[ConversationInput] = list()
+        self.stop_requested: bool = False
+        self.streaming_activity: Optional[ActivityHandle] = None
 
     @workflow.run
     async def run(
@@ -36,28 +104,123 @@ class ConversationThreadWorkflow:
         params: ConversationThreadParams,
     ) -> str:
         self.params = params
+        self.wire_format = negotiate_wire_format(params.wire_formats)
 
-        response = await workflow.execute_activity_method(
-            ConversationThreadActivities.create_thread,
-            schedule_to_close_timeout=timedelta(seconds=5),
-            retry_policy=RetryPolicy(
-                initial_interval= timedelta(seconds=2),
-                backoff_coefficient= 2.0,
-                maximum_interval= None,
-                maximum_attempts= 10,
-                non_retryable_error_types= None
+        if params.thread_id:
+            # Continued as new, only the compacted state is carried over
+            self.thread_id = params.thread_id
+            self.remote_city = params.remote_city
+            self.messages = list(params.history)
+            self.history_offset = params.history_offset
+            self.ready = True
+        else:
+            await self.prepare_thread(params)
+
+        # Messages are answered one burst at a time, so only one run is ever active on the thread
+        while True:
+            await self.wait_for_input()
+
+            if self.pending_inputs and not self.thread_closed:
+                await self.reply_to_pending_inputs()
+                continue
+
+            if self.thread_closed:
+                await self.close_thread()
+                return "thread closed"
+
+            break
+
+        tail = self.messages[-params.history_tail_size:] if params.history_tail_size > 0 else []
+        workflow.logger.info(f"Continuing thread {self.thread_id} as new with {len(tail)} messages")
+
+        workflow.continue_as_new(ConversationThreadParams(
+            remote_ip_address=params.remote_ip_address,
+            wire_formats=params.wire_formats,
+            max_history_length=params.max_history_length,
+            history_tail_size=params.history_tail_size,
+            idle_timeout_seconds=params.idle_timeout_seconds,
+            delete_thread_on_close=params.delete_thread_on_close,
+            thread_id=self.thread_id,
+            remote_city=self.remote_city,
+            history=tail,
+            history_offset=self.history_offset + len(self.messages) - len(tail),
+            coalesce_window_ms=params.coalesce_window_ms,
+            use_thread_pool=params.use_thread_pool,
+        ))
+
+    async def wait_for_input(self) -> None:
+        """
+        Returns once messages are pending, the thread is closed or the history should be
+        compacted. Closes the thread when nothing happens within the idle timeout.
+        """
+        try:
+            await workflow.wait_condition(
+                lambda: self.thread_closed or bool(self.pending_inputs) or self.history_too_long(),
+                timeout=self.params.idle_timeout_seconds or None,
+            )
+        except asyncio.TimeoutError:
+            workflow.logger.info(f"Closing idle thread {self.thread_id}")
+            self.close_reason = "idle"
+            self.thread_closed = True
+
+    async def close_thread(self) -> None:
+        try:
+            await workflow.execute_activity_method(
+                ConversationThreadActivities.close_thread,
+                CloseThreadRequest(
+                    thread_id=self.thread_id,
+                    reason=self.close_reason,
+                    delete_thread=self.params.delete_thread_on_close,
+                ),
+                schedule_to_close_timeout=timedelta(seconds=30),
+            )
+        except ActivityError as e:
+            # Stream keys expire on their own, a leftover thread is harmless
+            workflow.logger.warning(f"Failed to clean up thread {self.thread_id}: {e}")
+
+    def history_too_long(self) -> bool:
+        info = workflow.info()
+        return info.is_continue_as_new_suggested() or info.get_current_history_length() >= self.params.max_history_length
+
+    async def prepare_thread(self, params: ConversationThreadParams) -> None:
+        response = None
+        if params.use_thread_pool:
+            try:
+                response = await workflow.execute_activity_method(
+                    ThreadPoolActivities.claim_thread,
+                    schedule_to_close_timeout=timedelta(seconds=2),
+                    retry_policy=RetryPolicy(maximum_attempts=2),
+                )
+            except ActivityError as e:
+                workflow.logger.warning(f"Failed to claim a pooled thread: {e}")
+
+        if not response:
+            response = await workflow.execute_activity_method(
+                ConversationThreadActivities.create_thread,
+                schedule_to_close_timeout=RATE_LIMITED_CALL_TIMEOUT,
+                heartbeat_timeout=STREAM_HEARTBEAT_TIMEOUT,
+                retry_policy=RetryPolicy(
+                    initial_interval= timedelta(seconds=2),
+                    backoff_coefficient= 2.0,
+                    maximum_interval= None,
+                    maximum_attempts= 10,
+                    non_retryable_error_types= None
+                )
             )
-        )
 
-        workflow.logger.info("Created thread: " + response)
+            workflow.logger.info("Created thread: " + response)
 
         self.thread_id = response
 
         print("------------------- thread_id: " + self.thread_id)
 
+        # The user can start typing now, messages wait for the city context below
+        self.ready = True
+
         self.remote_city = await workflow.execute_activity_method(
             ConversationThreadActivities.get_city,
             params.remote_ip_address,
+            task_queue=TOOLS_TASK_QUEUE,
             schedule_to_close_timeout=timedelta(seconds=5),
             retry_policy=RetryPolicy(
                 initial_interval= timedelta(seconds=2),
@@ -71,74 +234,205 @@ class ConversationThreadWorkflow:
         await workflow.execute_activity_method(
             ConversationThreadActivities.add_message_to_thread,
             ConversationThreadMessage(thread_id=self.thread_id, message="User's city is " + self.remote_city, role="assistant"),
-            schedule_to_close_timeout=timedelta(seconds=5),
+            schedule_to_close_timeout=RATE_LIMITED_CALL_TIMEOUT,
+            heartbeat_timeout=STREAM_HEARTBEAT_TIMEOUT,
+            retry_policy=ADD_MESSAGE_RETRY_POLICY,
         )
 
-        await workflow.wait_condition(lambda: self.thread_closed)
-
-        return "thread closed"
-
     @workflow.query
     def get_thread_id(self) -> Optional[str]:
         return self.thread_id
 
+    @workflow.update
+    async def wait_until_ready(self) -> str:
+        """
+        Completes once the thread is claimed from the pool or created, returns the thread id.
+        """
+        await workflow.wait_condition(lambda: self.ready)
+        return self.thread_id
+
     @workflow.query
     def get_history(self) -> list[ConversationMessage]:
         return self.messages
 
+    @workflow.query
+    def get_history_page(self, request: HistoryPageRequest) -> HistoryPage:
+        """
+        Messages after `request.offset`, for rebuilding the UI of a resumed session.
+        """
+        offset = max(request.offset, self.history_offset)
+        start = offset - self.history_offset
+        messages = self.messages[start:start + request.limit]
+
+        return HistoryPage(
+            messages=messages,
+            offset=offset,
+            next_offset=offset + len(messages),
+            total=self.history_offset + len(self.messages),
+        )
+
     @workflow.signal
-    async def on_message(self, message: str):
+    def on_message(self, message: ConversationInput):
+        # A stop only applies to messages sent before it, including those still in the coalesce window
+        self.stop_requested = False
+        self.pending_inputs.append(message)
+
+    async def reply_to_pending_inputs(self):
+        if self.params.coalesce_window_ms > 0:
+            await asyncio.sleep(self.params.coalesce_window_ms / 1000)
+
+        inputs = self.pending_inputs
+        self.pending_inputs = []
+
+        failed = False
+        try:
+            await self.answer(inputs)
+        except ActivityError as e:
+            # The conversation goes on, the user can ask again
+            workflow.logger.error(f"Failed to answer {len(inputs)} messages on thread {self.thread_id}: {e}")
+            failed = True
+
+        # Streamed after everything the burst produced, so the app knows which messages it answered
+        await workflow.execute_activity_method(
+            ConversationThreadActivities.end_reply,
+            EndReplyRequest(
+                thread_id=self.thread_id,
+                message_ids=[message.message_id for message in inputs],
+                failed=failed,
+                history_length=self.history_offset + len(self.messages),
+                wire_format=self.wire_format,
+            ),
+            schedule_to_close_timeout=timedelta(seconds=10),
+        )
+
+    async def answer(self, inputs: List[ConversationInput]):
+        # Opening questions are answered the same way for everyone in the same city
+        first_turn = self.history_offset == 0 and not any(m.author == "assistant" for m in self.messages)
+
+        for message in inputs:
+            self.messages.append(ConversationMessage(author="", message=message.message))
+
+        # A burst becomes a single user message and a single run
+        prompt = "\n\n".join(message.message for message in inputs)
         await workflow.execute_activity_method(
             ConversationThreadActivities.add_message_to_thread,
-            ConversationThreadMessage(thread_id=self.thread_id, message=message),
-            schedule_to_close_timeout=timedelta(seconds=5),
+            ConversationThreadMessage(
+                thread_id=self.thread_id,
+                message=prompt,
+            ),
+            schedule_to_close_timeout=RATE_LIMITED_CALL_TIMEOUT,
+            heartbeat_timeout=STREAM_HEARTBEAT_TIMEOUT,
+            retry_policy=ADD_MESSAGE_RETRY_POLICY,
         )
 
-        self.messages.append(ConversationMessage(author="", message=message))
+        if self.stop_requested or self.thread_closed:
+            return
 
-        response = await workflow.execute_activity_method(
+        response = await self.stream_activity(
             ConversationThreadActivities.get_response,
-            self.thread_id,
-            schedule_to_close_timeout=timedelta(seconds=120),
+            ConversationThreadRunRequest(
+                thread_id=self.thread_id,
+                wire_format=self.wire_format,
+                cache_prompt=prompt if first_turn else "",
+                cache_context=f"first-turn:{self.remote_city}",
+            ),
         )
 
         print("----------------- Response ---------------")
         print(response)
 
-        while(response.tool_call_needed):
-            tool_arguments = response.tool_arguments
-            tool_arguments.update({
-                "location": self.remote_city,
-            })
+        while(response is not None and response.tool_call_needed and response.tool_calls):
+            for tool_call in response.tool_calls:
+                tool_call.tool_arguments.update({
+                    "location": self.remote_city,
+                })
 
-            tool_call_result = await workflow.execute_activity_method(
-                ConversationThreadActivities.function_call,
-                ToolCallRequest(
-                    tool_call_id=response.tool_call_id, 
-                    tool_function_name=response.tool_call_function_name, 
-                    tool_arguments=response.tool_arguments
-                ),
-                schedule_to_close_timeout=timedelta(seconds=120),
-            )
+            # All function calls of a step run concurrently and are submitted together
+            tool_call_results = await asyncio.gather(*[
+                self.call_tool(tool_call) for tool_call in response.tool_calls
+            ])
 
             print("-------------- Tool call result -------------")
-            print(tool_call_result)
+            print(tool_call_results)
 
-            response = await workflow.execute_activity_method(
+            if self.stop_requested or self.thread_closed:
+                # The run waits for tool outputs and would block the thread until it expires
+                await workflow.execute_activity_method(
+                    ConversationThreadActivities.cancel_run,
+                    CancelRunRequest(thread_id=response.thread_id, run_id=response.run_id, wire_format=self.wire_format),
+                    schedule_to_close_timeout=timedelta(seconds=10),
+                )
+                return
+
+            response = await self.stream_activity(
                 ConversationThreadActivities.submit_tool_call_result,
                 SubmitToolOutputsRequest(
                     thread_id=response.thread_id,
                     run_id=response.run_id,
-                    tool_outputs=[tool_call_result]
+                    tool_outputs=list(tool_call_results),
+                    wire_format=self.wire_format,
                 ),
-                schedule_to_close_timeout=timedelta(seconds=120),
             )
 
         print("------------- Done get_response--------------------")
         print(response)
 
-        self.messages.append(ConversationMessage(author="assistant", message=response.message))
+        if response is not None:
+            self.messages.append(ConversationMessage(author="assistant", message=response.message))
+
+    async def stream_activity(self, activity, request) -> Optional[ConversationThreadMessageResponse]:
+        """
+        Runs a streaming activity that stop_generating and end_thread can cancel, returns None
+        when it was cancelled. Waits for the cancellation to complete so the OpenAI run is
+        cancelled before the next one starts.
+        """
+        self.streaming_activity = workflow.start_activity_method(
+            activity,
+            request,
+            task_queue=LLM_TASK_QUEUE,
+            schedule_to_close_timeout=timedelta(seconds=120),
+            heartbeat_timeout=STREAM_HEARTBEAT_TIMEOUT,
+            cancellation_type=ActivityCancellationType.WAIT_CANCELLATION_COMPLETED,
+        )
+        try:
+            return await self.streaming_activity
+        except ActivityError as e:
+            if not isinstance(e.cause, CancelledError):
+                raise
+            workflow.logger.info(f"Stopped generating on thread {self.thread_id}")
+            return None
+        finally:
+            self.streaming_activity = None
+
+    def cancel_generation(self) -> None:
+        self.stop_requested = True
+        if self.streaming_activity is not None:
+            self.streaming_activity.cancel()
+
+    @workflow.signal
+    def stop_generating(self):
+        self.cancel_generation()
+
+    async def call_tool(self, tool_call: ToolCallRequest) -> ToolCallResult:
+        # Every tool is scheduled with its own timeout and retries
+        policy = get_tool_policy(tool_call.tool_function_name)
+
+        try:
+            return await workflow.execute_activity_method(
+                ConversationThreadActivities.function_call,
+                tool_call,
+                task_queue=TOOLS_TASK_QUEUE,
+                schedule_to_close_timeout=policy.timeout,
+                retry_policy=policy.retry_policy,
+            )
+        except ActivityError as e:
+            workflow.logger.warning(f"Tool {tool_call.tool_function_name} failed: {e}")
+            return ToolCallResult(
+                tool_call_id=tool_call.tool_call_id,
+                output=json.dumps({"error": f"{tool_call.tool_function_name} is not available right now."}),
+            )
 
     @workflow.signal
-    async def end_thread(self):
-        self.thread_closed = True
\ No newline at end of file
+    def end_thread(self):
+        self.thread_closed = True
+        self.cancel_generation()
\ No newline at end of file
@@ -0,0 +1,51 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import timedelta
+
+from temporalio import workflow
+from temporalio.common import RetryPolicy
+from temporalio.exceptions import ActivityError
+
+with workflow.unsafe.imports_passed_through():
+    from activities.thread_pool_activities import ThreadPoolActivities
+
+
+THREAD_POOL_WORKFLOW_ID = "openai-thread-pool-refill"
+
+
+@dataclass
+class ThreadPoolParams:
+    target_size: int
+    refill_interval_seconds: int = 10
+    # Keeps the event history of this never-ending workflow short
+    iterations_before_continue_as_new: int = 500
+
+@workflow.defn
+class ThreadPoolRefillWorkflow:
+    @workflow.run
+    async def run(self, params: ThreadPoolParams) -> None:
+        for _ in range(params.iterations_before_continue_as_new):
+            try:
+                created = await workflow.execute_activity_method(
+                    ThreadPoolActivities.refill_thread_pool,
+                    params.target_size,
+                    schedule_to_close_timeout=timedelta(seconds=60),
+                    retry_policy=RetryPolicy(
+                        initial_interval= timedelta(seconds=2),
+                        backoff_coefficient= 2.0,
+                        maximum_interval= timedelta(seconds=30),
+                        maximum_attempts= 3,
+                        non_retryable_error_types= None
+                    )
+                )
+            except ActivityError as e:
+                # Conversations fall back to creating their own thread, try again on the next tick
+                workflow.logger.warning(f"Failed to refill thread pool: {e}")
+                created = 0
+
+            if created:
+                workflow.logger.info(f"Refilled thread pool with {created} threads")
+
+            await asyncio.sleep(params.refill_interval_seconds)
+
+        workflow.continue_as_new(params)